@@ -0,0 +1,78 @@
+import sys
+import time
+import resource
+from multiprocessing import get_context
+import cv2 as cv
+import numpy as np
+
+from utils.disparity import LEVELS, banded_disparity, band_layout, match, blur_new, compute_pyramid
+
+def read_pair(name, dim):
+    """
+    Read a pair of images upscaled to the tested resolution
+    """
+    gray_imgL = cv.imread('assets/' + name + '.jpg', cv.IMREAD_GRAYSCALE)
+    gray_imgR = cv.imread('assets/' + name.replace("left", "right") + '.jpg', cv.IMREAD_GRAYSCALE)
+    
+    return cv.resize(gray_imgL, dim), cv.resize(gray_imgR, dim)
+
+
+def measure(name, dim, budget, workers):
+    """
+    Return the running time (s), the peak memory growth (MB) and the disparity of a full-frame
+    or banded (if `budget` is not None) computation
+    """
+    gray_imgL, gray_imgR = read_pair(name, dim)
+    params = LEVELS["high"]
+    
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if budget is None:
+        disparity = match(blur_new(gray_imgL, params), blur_new(gray_imgR, params), params)
+    else:
+        disparity = banded_disparity(gray_imgL, gray_imgR, params, budget * 2 ** 20, workers)
+    elapsed = time.perf_counter() - start
+    
+    return elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss) / 1024, disparity
+
+
+def scale_error(name, dim, budget):
+    """
+    Return the median difference between the high level of a pair upscaled to `dim` (matched by bands)
+    and of the pair at 720p, over the pixels matched at both resolutions
+    """
+    reference = compute_pyramid(*read_pair(name, LEVELS["high"]["dimension"])).full("high")
+    scaled = compute_pyramid(*read_pair(name, dim), band_budget = budget * 2 ** 20).full("high")
+    scaled = cv.resize(scaled, LEVELS["high"]["dimension"], interpolation = cv.INTER_NEAREST)
+    matched = (reference >= 0) & (scaled >= 0)
+    
+    return float(np.median(scaled[matched] - reference[matched]))
+
+
+def main(name = "stereo/position1/left", dim = (3840, 2160), budget = 64, workers = None,
+         scales = ((1920, 1080), (2560, 1440)), tolerance = 0.005):
+    # Measure each computation in a fresh process, the peak memory of a process only grows
+    context = get_context("spawn")
+    results = {}
+    for mode, mode_budget in (("Full frame", None), ("Bands", budget)):
+        with context.Pool(1) as pool:
+            results[mode] = pool.apply(measure, (name, dim, mode_budget, workers))
+    
+    concurrency, rows = band_layout(dim[1], dim[0], LEVELS["high"], budget * 2 ** 20, workers)
+    print("Image: %s (%dx%d), budget %d MB, %d band(s) of %d rows at once" % (name, dim[0], dim[1], budget,
+                                                                         concurrency, rows))
+    for mode, (elapsed, rss, _) in results.items():
+        print("%-11s %6.2f s, +%6.1f MB" % (mode + ":", elapsed, rss))
+    print("Different pixels: %.3f%%" % (100 * np.mean(results["Full frame"][2] != results["Bands"][2])))
+    
+    # The scaled disparities of larger inputs must keep the meaning of the 720p ones
+    errors = {scale: scale_error(name, scale, budget) for scale in scales}
+    for (width, height), error in errors.items():
+        print("%dx%d vs 720p: median difference %+.4f" % (width, height, error))
+    
+    return all(abs(error) <= tolerance for error in errors.values())
+    
+    
+if __name__ == "__main__":
+    # Run from the project's root folder: python -m benchmarks.bands
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,64 @@
+import time
+import cv2 as cv
+import numpy as np
+
+from utils.helpers import merge_range
+from utils.disparity import return_disparity, combine_disparity, return_ranges
+
+def combine_disparity_loop(dim, low, mid, high, value_ranges):
+    """
+    Reference per-pixel implementation of `combine_disparity`
+    """
+    combined = low.copy()
+
+    for value_range in value_ranges:
+        for i in range(dim[1]):
+            for j in range(dim[0]):
+                low_value, mid_value, high_value = low[i][j], mid[i][j], high[i][j]
+                if low_value > value_range[0] and low_value < value_range[1]:
+                    combined[i][j] = (5 * low_value + 3 * mid_value + 2 * high_value) / 10
+
+    return combined
+
+
+def timeit(func, repeat):
+    """
+    Return the best running time (s) of `func` and its last result
+    """
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def main(name = "stereo/position1/left", repeat = 20):
+    # Read images and calculate the disparity of every resolution
+    gray_imgL = cv.imread('assets/' + name + '.jpg', cv.IMREAD_GRAYSCALE)
+    gray_imgR = cv.imread('assets/' + name.replace("left", "right") + '.jpg', cv.IMREAD_GRAYSCALE)
+    hi, mid, low = return_disparity(gray_imgL, gray_imgR)
+
+    # Specify the ranges to be fused
+    dim = gray_imgL.shape[::-1]
+    value_ranges = merge_range(return_ranges(low, 0.05, 0.25, 2, 50000))
+    if len(value_ranges) == 0:
+        value_ranges = [[0.05, 0.25]]
+
+    # Time both implementations
+    loop_time, expected = timeit(lambda: combine_disparity_loop(dim, low, mid, hi, value_ranges), 1)
+    vector_time, result = timeit(lambda: combine_disparity(dim, low, mid, hi, value_ranges), repeat)
+    out = np.empty_like(low)
+    inplace_time, _ = timeit(lambda: combine_disparity(dim, low, mid, hi, value_ranges, out = out), repeat)
+
+    print("Image: %s (%dx%d), %d range(s)" % (name, dim[0], dim[1], len(value_ranges)))
+    print("Per-pixel loop:  %9.2f ms" % (loop_time * 1000))
+    print("Vectorized:      %9.2f ms (x%.0f)" % (vector_time * 1000, loop_time / vector_time))
+    print("Vectorized, out: %9.2f ms (x%.0f)" % (inplace_time * 1000, loop_time / inplace_time))
+    print("Identical:       %s" % (np.array_equal(expected, result) and np.array_equal(expected, out)))
+
+
+if __name__ == "__main__":
+    # Run from the project's root folder: python -m benchmarks.fusion
+    main()
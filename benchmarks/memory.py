@@ -0,0 +1,48 @@
+import tempfile
+import tracemalloc
+import cv2 as cv
+
+from main import process
+from utils.camera import load_camera
+from utils.helpers import BufferArena
+
+def peak_allocation(func, repeat):
+    """
+    Return the largest peak of memory (bytes) allocated by NumPy and Python during a call of `func`,
+    after a first call that warms up the caches
+    """
+    func()
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        func()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        
+    return peak
+
+
+def main(names = ("stereo/position1/left", "mono/position1/left"), repeat = 3):
+    camera = load_camera()
+    arena = BufferArena()
+    
+    with tempfile.TemporaryDirectory() as folder:
+        output = folder + "/"
+        for name in names:
+            imgL = cv.imread('assets/' + name + '.jpg')
+            imgR = cv.imread('assets/' + name.replace("left", "right") + '.jpg')
+            stereo = "stereo" in name
+            
+            # Peak allocation of a pair with the float64 maps, then with the float32 maps of the arena
+            default = peak_allocation(lambda: process(imgL, imgR, "pair", stereo, output, camera), repeat)
+            buffered = peak_allocation(lambda: process(imgL, imgR, "pair", stereo, output, camera, arena), repeat)
+            
+            print("%s:" % name)
+            print("  float64:             %7.1f MB" % (default / 2 ** 20))
+            print("  float32 with arena:  %7.1f MB (x%.2f less), %.1f MB held by the arena"
+                  % (buffered / 2 ** 20, default / buffered, arena.nbytes() / 2 ** 20))
+            
+            
+if __name__ == "__main__":
+    # Run from the project's root folder: python -m benchmarks.memory
+    main()
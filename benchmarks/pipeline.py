@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import resource
+import cv2 as cv
+import numpy as np
+
+from main import find_pairs, is_stereo
+from utils.camera import load_camera
+from utils.disparity import compute_pyramid, DisparityHistogram, LEVELS
+from utils.depth import return_depth, load_depth_luts, detect_objects, point_cloud, write_ply
+from utils.rectify import load_rig_profile
+from utils.helpers import normalize
+
+# Stages of the pipeline, in running order
+STAGES = ["load", "grayscale", "rectify", "pyramid"] + ["disparity_" + name for name in LEVELS] + \
+         ["ranges", "combine", "depth", "objects", "point_cloud", "write_ply"]
+
+def run_pair(left, right, stereo, camera, folder):
+    """
+    Run the pipeline on a pair of images and return the running time (s) of every stage and its outputs
+    """
+    timings, start = {}, time.perf_counter()
+
+    def lap(stage):
+        nonlocal start
+        now = time.perf_counter()
+        timings[stage], start = now - start, now
+
+    # Read the images
+    imgL, imgR = cv.imread(left), cv.imread(right)
+    lap("load")
+
+    gray_imgL = cv.cvtColor(imgL, cv.COLOR_BGR2GRAY)
+    gray_imgR = cv.cvtColor(imgR, cv.COLOR_BGR2GRAY)
+    lap("grayscale")
+
+    # Rectify (only the mono rig needs it)
+    if not stereo:
+        rig = load_rig_profile(gray_imgL, gray_imgR, camera = camera)
+        gray_imgL, gray_imgR = rig.undistort(gray_imgL, gray_imgR)
+        imgL = rig.undistort_image(imgL, "left")
+    lap("rectify")
+
+    # Calculate the disparity of every level, timed by the pyramid itself
+    levels = {}
+    pyramid = compute_pyramid(gray_imgL, gray_imgR, timings = levels)
+    timings["pyramid"] = levels["pyramid"]["left"] + levels["pyramid"]["right"]
+    for name in LEVELS:
+        timings["disparity_" + name] = levels[name]["total"]
+    start = time.perf_counter()
+
+    histogram = DisparityHistogram(pyramid.native("low"), dim = pyramid.dim)
+    range_low = histogram.ranges(0.25, 1.25, 10, 50000)
+    range_mid_high = histogram.ranges(0.05, 0.25, 2, 50000, merge = True)
+    lap("ranges")
+
+    combined = pyramid.combine(range_mid_high)
+    lap("combine")
+
+    # Calculate the depth map and remove the out-of-bound area
+    depth_map = return_depth(combined, stereo, camera = camera)
+    mask = cv.inRange(depth_map, 0, 170)
+    depth_safe = normalize(cv.bitwise_and(depth_map, depth_map, mask = mask))
+    lap("depth")
+
+    detections = detect_objects(combined, range_low, load_depth_luts(camera)["stereo" if stereo else "mono"])
+    lap("objects")
+
+    points = point_cloud(imgL, depth_safe)
+    lap("point_cloud")
+
+    write_ply(points, os.path.join(folder, "points.ply"))
+    lap("write_ply")
+
+    return timings, {"combined": combined, "detections": detections}
+
+
+def golden_record(name, outputs):
+    """
+    Return the arrays that identify the outputs of a pair in the golden file
+    """
+    detections = outputs["detections"]
+    boxes = detections[['x_left', 'y_top', 'x_right', 'y_bot']].tolist()
+
+    return {name + "/combined": outputs["combined"][::8, ::8].astype(np.float32),
+            name + "/boxes": np.array(boxes, np.int32).reshape(-1, 4),
+            name + "/depth": detections["depth"]}
+
+
+def check_golden(golden, record, atol = 1e-4):
+    """
+    Return the keys of a record that differ from the golden outputs
+    """
+    different = []
+    for key, value in record.items():
+        expected = golden.get(key)
+        if expected is None or expected.shape != value.shape or not np.allclose(expected, value, atol = atol, equal_nan = True):
+            different.append(key)
+
+    return different
+
+
+def summarize(samples):
+    """
+    Return the median and 95th percentile (ms) of running times (s)
+    """
+    samples = np.array(samples) * 1000
+
+    return {"median_ms": float(np.median(samples)), "p95_ms": float(np.percentile(samples, 95))}
+
+
+def compare(report, baseline):
+    """
+    Return the speedup of the median of every stage over a baseline report
+    """
+    speedups = {}
+    for stage, stats in report["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if before is not None and stats["median_ms"] > 0:
+            speedups[stage] = before["median_ms"] / stats["median_ms"]
+
+    return speedups
+
+
+def main(folders, repeat = 5, output = "outputs/benchmark.json", baseline = None,
+         golden = "benchmarks/golden.npz", update_golden = False):
+    """
+    Benchmark every stage of the pipeline over the pairs of the input folders
+
+    Params:
+        folders (list): folders to search for "*left.jpg" and "*right.jpg" pairs
+        repeat (int): # of runs of every pair, the first one warms up the caches and is not timed
+        output (str): JSON report
+        baseline (str): previous JSON report to compare with
+        golden (str): .npz of the expected outputs, tracked with the code
+        update_golden (bool): if True, write the current outputs as the golden ones instead of checking them,
+            only to be done from the reference (float64) pipeline
+
+    Returns:
+        bool: True if the outputs match the golden ones
+    """
+    if not update_golden and not os.path.exists(golden):
+        raise FileNotFoundError("No golden outputs at %s, generate them with --update-golden" % golden)
+    
+    camera = load_camera()
+    pairs = [(name, left, right, is_stereo(left)) for folder in folders for name, left, right in find_pairs(folder)]
+    samples = {stage: [] for stage in STAGES}
+    totals, records = [], {}
+
+    with tempfile.TemporaryDirectory() as folder:
+        for name, left, right, stereo in pairs:
+            for i in range(repeat + 1):
+                start = time.perf_counter()
+                timings, outputs = run_pair(left, right, stereo, camera, folder)
+                if i > 0:
+                    totals.append(time.perf_counter() - start)
+                    for stage, elapsed in timings.items():
+                        samples[stage].append(elapsed)
+            records.update(golden_record(name, outputs))
+
+    report = {
+        "pairs": len(pairs),
+        "repeat": repeat,
+        "stages": {stage: summarize(values) for stage, values in samples.items() if values},
+        "total": summarize(totals),
+        "throughput_pairs_per_s": len(totals) / sum(totals),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+    # Check the outputs against the golden ones
+    if update_golden:
+        np.savez_compressed(golden, **records)
+        report["golden"] = {"path": golden, "updated": True, "different": []}
+    else:
+        with np.load(golden) as file:
+            different = check_golden(dict(file), records)
+        report["golden"] = {"path": golden, "updated": False, "different": different}
+
+    if baseline is not None:
+        with open(baseline) as file:
+            report["speedup"] = compare(report, json.load(file))
+
+    with open(output, "w") as file:
+        json.dump(report, file, indent = 2)
+
+    # Print the summary
+    for stage, stats in report["stages"].items():
+        speedup = report.get("speedup", {}).get(stage)
+        print("%-15s median %8.2f ms, p95 %8.2f ms%s" % (stage, stats["median_ms"], stats["p95_ms"],
+                                                        " (x%.2f)" % speedup if speedup else ""))
+    print("Throughput: %.2f pairs/s, peak RSS: %.1f MB" % (report["throughput_pairs_per_s"], report["peak_rss_mb"]))
+    if report["golden"]["different"]:
+        print("Outputs different from %s: %s" % (golden, ", ".join(report["golden"]["different"])))
+
+    return not report["golden"]["different"]
+
+
+if __name__ == "__main__":
+    # Run from the project's root folder: python -m benchmarks.pipeline
+    parser = argparse.ArgumentParser(description = "Benchmark every stage of the pipeline over the bundled assets")
+    parser.add_argument("folders", nargs = "*", default = ["assets/stereo", "assets/mono", "assets/finetuning"],
+                        help = "folders containing *left.jpg/*right.jpg pairs")
+    parser.add_argument("--repeat", type = int, default = 5, help = "# of timed runs of every pair")
+    parser.add_argument("--output", default = "outputs/benchmark.json", help = "JSON report")
+    parser.add_argument("--baseline", default = None, help = "previous JSON report to compare with")
+    parser.add_argument("--golden", default = "benchmarks/golden.npz", help = "expected outputs of every pair")
+    parser.add_argument("--update-golden", action = "store_true",
+                        help = "write the current outputs as the expected ones (from the reference pipeline only)")
+    args = parser.parse_args()
+
+    sys.exit(0 if main(args.folders, args.repeat, args.output, args.baseline, args.golden, args.update_golden) else 1)
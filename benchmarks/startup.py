@@ -0,0 +1,101 @@
+import sys
+import argparse
+import subprocess
+
+# Entry points and the third-party packages each of them may import
+ENTRY_POINTS = {
+    "realtime": {"cv2", "numpy", "yaml"},
+    "main": {"cv2", "numpy", "yaml"},
+    "utils.depth": {"cv2", "numpy", "yaml"},
+    "utils.calibration": {"cv2", "numpy", "yaml"},
+}
+
+def import_times(module):
+    """
+    Return the cumulative import time (us) and the nesting depth of every package imported by a module,
+    in a fresh interpreter
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            capture_output = True, text = True, check = True)
+    
+    # Lines are "import time: self [us] | cumulative | imported package", nested imports being indented
+    # and listed before the package importing them
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        entries.append((name.strip(), int(cumulative), (len(name) - len(name.lstrip()) - 1) // 2))
+    
+    # Only keep the module and the packages it imports, not the interpreter's startup
+    end = max(i for i, (name, _, depth) in enumerate(entries) if name == module and depth == 0)
+    start = end
+    while start > 0 and entries[start - 1][2] > 0:
+        start -= 1
+    
+    # The parent of a package is the next one listed with a smaller depth
+    times, parents = {}, []
+    for name, cumulative, depth in reversed(entries[start:end + 1]):
+        del parents[depth:]
+        times.setdefault(name, (cumulative, depth, parents[-1] if parents else None))
+        parents.append(name)
+            
+    return times
+
+
+def is_project(name):
+    """
+    Tell if a package is one of the project's modules
+    """
+    return name.split(".")[0] in ("utils", "main", "realtime", "benchmarks")
+
+
+def third_party(times):
+    """
+    Return the packages imported by the project's modules that are neither part of the standard library nor of the project
+    """
+    packages = {name.split(".")[0] for name, (_, _, parent) in times.items() if parent is not None and is_project(parent)}
+    
+    return {name for name in packages if not is_project(name)} - set(sys.stdlib_module_names)
+
+
+def main(repeat = 5, budget = None):
+    """
+    Measure the import time of every entry point (best of `repeat` runs)
+    and check that it only imports its allowed packages and, if `budget` (ms) is given, fits in it
+    """
+    passed = True
+    for module, allowed in ENTRY_POINTS.items():
+        try:
+            runs = [import_times(module) for _ in range(repeat)]
+        except subprocess.CalledProcessError as error:
+            print("%-18s failed: %s" % (module, error.stderr.strip().splitlines()[-1]))
+            passed = False
+            continue
+        best = min(runs, key = lambda times: times[module][0])
+        total = best[module][0] / 1000
+        
+        # Slowest packages imported by the entry point itself
+        slowest = sorted(((elapsed, name) for name, (elapsed, depth, _) in best.items() if depth == 1), reverse = True)[:3]
+        print("%-18s %8.1f ms  (%s)" % (module, total, ", ".join("%s %.1f ms" % (name, elapsed / 1000)
+                                                                for elapsed, name in slowest)))
+        
+        extra = sorted(set().union(*map(third_party, runs)) - allowed)
+        if extra:
+            print("  unexpected imports: %s" % ", ".join(extra))
+            passed = False
+        if budget is not None and total > budget:
+            print("  over the %.1f ms budget" % budget)
+            passed = False
+            
+    return passed
+
+
+if __name__ == "__main__":
+    # Run from the project's root folder: python -m benchmarks.startup
+    parser = argparse.ArgumentParser(description = "Measure the import time of the entry points with -X importtime")
+    parser.add_argument("--repeat", type = int, default = 5, help = "# of fresh interpreters per entry point")
+    parser.add_argument("--budget", type = float, default = None, help = "maximum import time (ms) of an entry point")
+    args = parser.parse_args()
+    
+    sys.exit(0 if main(args.repeat, args.budget) else 1)
@@ -1,64 +1,88 @@
+import os
+import glob
+import json
+import time
+import argparse
+from multiprocessing import Pool
 import cv2 as cv
 import numpy as np
-from matplotlib import pyplot as plt
-from utils.depth import return_depth, px_cm_ratio, depth_to_ply, display_individual_depth
-from utils.disparity import return_disparity, combine_disparity, return_ranges
-from utils.rectify import rectify, undistort
-from utils.helpers import normalize, merge_range, draw_text
+from utils.depth import return_depth, depth_to_ply, detect_objects, load_depth_luts, PLY_DTYPE
+from utils.disparity import compute_pyramid, DisparityHistogram
+from utils.rectify import load_rig_profile
+from utils.helpers import normalize, draw_text, BufferArena
+from utils.camera import load_camera
+
+def process(imgL, imgR, name, stereo, output = "outputs/", camera = None, arena = None, band_budget = None,
+            rectify_mode = "sift"):
+    """
+    Calculate the objects' depth of a pair of images and write the disparity, the annotated image
+    and the point cloud to the output folder. Return the detected objects and the timings (s) of every stage.
+    If an `arena` (see utils/helpers.py) is given, the maps are float32 and their buffers are reused across pairs.
+    If a `band_budget` (bytes) is given, pairs larger than 720p are matched at their resolution within that budget.
+    `rectify_mode` is the features the mono rig is rectified with, "sift" or the faster "orb" (see utils/rectify.py).
+    """
+    camera = camera if camera is not None else load_camera()
+    lut = load_depth_luts(camera)["stereo" if stereo else "mono"]
+    timings, start = {}, time.perf_counter()
+
+    def lap(stage):
+        nonlocal start
+        now = time.perf_counter()
+        timings[stage], start = now - start, now
 
-def main(name, stereo):
-    # Convert filename to paths and read images
-    filepath = name.replace("_", "/")
-    imgL = cv.imread('assets/' + filepath + '.jpg')
-    imgR = cv.imread('assets/' + filepath.replace("left", "right") + '.jpg')
-    
     # Convert to grayscale
     gray_imgL = cv.cvtColor(imgL, cv.COLOR_BGR2GRAY)
     gray_imgR = cv.cvtColor(imgR, cv.COLOR_BGR2GRAY)
-    
-    # Rectify
-    retification = rectify(imgL = gray_imgL, imgR = gray_imgR)
-    rec_imgL, rec_imgR = undistort(gray_imgL, gray_imgR, retification)
-    gray_imgL, gray_imgR = (rec_imgL, rec_imgR) if not stereo else (gray_imgL, gray_imgR)
+
+    # Rectify (only the mono rig needs it)
+    if not stereo:
+        rig = load_rig_profile(gray_imgL, gray_imgR, camera = camera, mode = rectify_mode)
+        gray_imgL, gray_imgR = rig.undistort(gray_imgL, gray_imgR)
+    lap("rectify")
 
     # Calculate disparity
-    hi, mid, low = return_disparity(gray_imgL, gray_imgR)
+    dtype = np.float32 if arena is not None else np.float64
+    pyramid = compute_pyramid(gray_imgL, gray_imgR, dtype = dtype, arena = arena, band_budget = band_budget)
+    lap("disparity")
 
-    # Specify the dectected ranges
-    range_low = return_ranges(low, 0.25, 1.25, 10, 50000)
-    range_mid_high = merge_range(return_ranges(low, 0.05, 0.25, 2, 50000))
+    # Specify the dectected ranges (from one histogram of the native 180p disparity)
+    histogram = DisparityHistogram(pyramid.native("low"), dim = pyramid.dim)
+    range_low = histogram.ranges(0.25, 1.25, 10, 50000)
+    range_mid_high = histogram.ranges(0.05, 0.25, 2, 50000, merge = True)
 
     # Combine disparity of different resolution
-    combined = combine_disparity(gray_imgL.shape[::-1], low, mid, hi, range_mid_high)
-    
-    # Calculate depth map
-    depth_map = return_depth(combined, stereo)
-    new_img = undistort(imgL, imgR, retification)[0] if not stereo else imgL
+    combined = pyramid.combine(range_mid_high)
+    lap("combine")
 
-    # Compute point cloud
-    height, width = depth_map.shape
-    pcd = np.zeros((height, width, 3))
+    # Calculate depth map
+    buffer = lambda name: arena.get(name, combined.shape, dtype) if arena is not None else None
+    depth_map = return_depth(combined, stereo, camera = camera, out = buffer("depth"))
+    new_img = rig.undistort_image(imgL, "left") if not stereo else imgL
 
     # Remove out-of-bound area
     mask = cv.inRange(depth_map, 0, 170)
-    depth_safe = cv.bitwise_and(depth_map, depth_map, mask = mask)
-    norm_depth_safe = normalize(depth_safe)
-
-    # Calculate point cloud values
-    for i in range(height):
-        for j in range(width):
-            pcd[i][j] = [i, j, norm_depth_safe[i][j]]
-        
+    depth_safe = depth_map
+    depth_safe[mask == 0] = 0
+    norm_depth_safe = normalize(depth_safe, out = depth_safe)
+
     # Generate point cloud file from depth map
-    _, data = depth_to_ply(new_img, pcd, name)
-    
+    points = arena.get("points", combined.shape, PLY_DTYPE) if arena is not None else None
+    depth_to_ply(new_img, norm_depth_safe, name, output, points)
+    lap("point_cloud")
+
     # Create canvas for visualization
-    canvas_dispar = normalize(combined)
-    canvas_img = new_img.copy()
-    
+    canvas_dispar = normalize(combined, out = buffer("canvas"))
+    if arena is not None:
+        canvas_img = arena.get("canvas_img", new_img.shape, new_img.dtype)
+        np.copyto(canvas_img, new_img)
+    else:
+        canvas_img = new_img.copy()
+
     # Show depth and warning text
-    for dispar_range in range_low:
-        x_left, y_top, x_right, y_bot, value = display_individual_depth(combined, dispar_range, stereo)
+    objects = []
+    detections = detect_objects(combined, range_low, lut)
+    for x_left, y_top, x_right, y_bot, value in detections[['x_left', 'y_top', 'x_right', 'y_bot', 'depth']].tolist():
+        objects.append({"box": [x_left, y_top, x_right, y_bot], "depth_cm": value})
 
         # Put text on disparity image
         draw_text(canvas_dispar, "Object at %.2f cm" % value, (x_left + 5, y_top - 10))
@@ -73,16 +97,177 @@ def main(name, stereo):
             draw_text(canvas_dispar, "WARNING: Object closer than 50cm!", (50, 50))
             cv.putText(canvas_img, "WARNING: Object closer than 50cm!",
                        (50, 50), 1, 2, (0, 0, 255), 2, 2)
-            
-    cv.imwrite("outputs/" + name + "_dispar.jpg", canvas_dispar) 
-    cv.imwrite("outputs/" + name + ".jpg", canvas_img) 
-            
+    lap("objects")
+
+    cv.imwrite(output + name + "_dispar.jpg", canvas_dispar)
+    cv.imwrite(output + name + ".jpg", canvas_img)
+    lap("write")
+
+    return objects, timings
+
+
+def main(name, stereo):
+    # Convert filename to paths and read images
+    filepath = name.replace("_", "/")
+    imgL = cv.imread('assets/' + filepath + '.jpg')
+    imgR = cv.imread('assets/' + filepath.replace("left", "right") + '.jpg')
+
+    return process(imgL, imgR, name, stereo)
+
+
+def find_pairs(folder):
+    """
+    Return the (name, left path, right path) of every stereo pair under a folder.
+    The name is the pair's path relative to the folder's parent, with "_" as separator.
+    """
+    pairs = []
+    parent = os.path.dirname(os.path.normpath(folder))
+    for left in sorted(glob.glob(os.path.join(folder, "**", "*left.jpg"), recursive = True)):
+        head, tail = os.path.split(left)
+        right = os.path.join(head, tail[:-len("left.jpg")] + "right.jpg")
+        if os.path.exists(right):
+            name = os.path.splitext(os.path.relpath(left, parent))[0].replace(os.sep, "_")
+            pairs.append((name, left, right))
+
+    return pairs
+
+
+def output_paths(name, output):
+    """
+    Return the paths of every output of a pair
+    """
+    return [output + name + "_dispar.jpg", output + name + ".jpg", output + name + ".ply"]
+
+
+def up_to_date(name, left, right, output):
+    """
+    Check if every output of a pair exists and is newer than its input images
+    """
+    paths = output_paths(name, output)
+    if not all(os.path.exists(path) for path in paths):
+        return False
+
+    return min(os.path.getmtime(path) for path in paths) >= max(os.path.getmtime(left), os.path.getmtime(right))
+
+
+def is_stereo(path, rig = "auto"):
+    """
+    Tell if a pair comes from the stereo rig, guessed from its path if `rig` is "auto"
+    """
+    return "stereo" in path if rig == "auto" else rig == "stereo"
+
+
+def init_worker():
+    # One OpenCV thread per process, the pool already uses every core
+    cv.setNumThreads(1)
+
+
+# Work buffers of the float32 mode, reused by every pair of the process
+_ARENA = BufferArena()
+
+def process_pair(task):
+    """
+    Process a pair of the batch and return its manifest record.
+    A pair that can't be read or processed gets a record with its error, without outputs, so it is retried on resume.
+    """
+    name, left, right, stereo, output, float32, band_budget, rectify_mode = task
+    record = {"name": name, "left": left, "right": right, "stereo": stereo}
+    start = time.perf_counter()
+    try:
+        imgL, imgR = cv.imread(left), cv.imread(right)
+        if imgL is None or imgR is None:
+            raise IOError("Can't read %s" % (left if imgL is None else right))
+        read_time = time.perf_counter() - start
+
+        objects, timings = process(imgL, imgR, name, stereo, output, arena = _ARENA if float32 else None,
+                                   band_budget = band_budget, rectify_mode = rectify_mode)
+    except (IOError, ValueError, cv.error) as error:
+        return {**record, "error": "%s: %s" % (type(error).__name__, error),
+                "timings": {"total": time.perf_counter() - start}}
+    timings = {"read": read_time, **timings, "total": time.perf_counter() - start}
+
+    return {**record, "objects": objects, "timings": timings}
+
+
+def batch(folders, output = "outputs/", rig = "auto", workers = None, chunksize = 1, manifest = None, resume = True,
+          float32 = False, band_budget = None, rectify_mode = "sift"):
+    """
+    Process every stereo pair under the input folders on a process pool
+
+    Params:
+        folders (list): folders to search for "*left.jpg" and "*right.jpg" pairs
+        output (str): folder of the outputs
+        rig (str): "stereo", "mono" or "auto" to guess it from the pair's path
+        workers (int): # of processes, all cores if None
+        chunksize (int): # of pairs sent to a process at once
+        manifest (str): JSON-lines file where a record is appended for every processed pair
+        resume (bool): if True, skip the pairs whose outputs are up to date
+        float32 (bool): if True, compute the maps in float32 into buffers reused across pairs
+        band_budget (int): if given, memory budget (bytes) of the bands matching the pairs larger than 720p
+            at their resolution (see `utils.disparity.banded_disparity`)
+        rectify_mode (str): features the mono rig is rectified with, "sift" or the faster "orb"
+
+    Returns:
+        (int, int, int): # of processed, skipped and failed pairs
+    """
+    manifest = manifest if manifest is not None else output + "manifest.jsonl"
+    os.makedirs(output, exist_ok = True)
+
+    # Find the pairs to be processed
+    pairs = [pair for folder in folders for pair in find_pairs(folder)]
+    tasks = [(name, left, right, is_stereo(left, rig), output, float32, band_budget, rectify_mode)
+             for name, left, right in pairs if not (resume and up_to_date(name, left, right, output))]
+
+    # Compute the rig profile and the depth lookup tables once before the workers need them
+    camera = load_camera()
+    for task in tasks:
+        if not task[3]:
+            imgL, imgR = cv.imread(task[1], cv.IMREAD_GRAYSCALE), cv.imread(task[2], cv.IMREAD_GRAYSCALE)
+            if imgL is not None and imgR is not None:
+                load_rig_profile(imgL, imgR, camera = camera, mode = rectify_mode)
+                break
+    if tasks:
+        load_depth_luts(camera)
+
+    # Process the pairs and write their records as soon as they are done
+    failed = 0
+    with open(manifest, "a") as file, Pool(workers, initializer = init_worker) as pool:
+        for record in pool.imap_unordered(process_pair, tasks, chunksize):
+            file.write(json.dumps(record) + "\n")
+            file.flush()
+            if "error" in record:
+                failed += 1
+                print("%s: failed, %s" % (record["name"], record["error"]))
+            else:
+                print("%s: %d object(s) in %.2f s" % (record["name"], len(record["objects"]),
+                                                      record["timings"]["total"]))
+
+    return len(tasks) - failed, len(pairs) - len(tasks), failed
+
+
 if __name__ == "__main__":
-     # `name`: filename + subpath -> final path: "assets/" + name + ".jpg"
-    # Set `stereo` = True if using stereo camera, else False.
-    main(name = "stereo_position1_left", stereo = True)
-    main(name = "stereo_position2_left", stereo = True)
-    main(name = "stereo_position3_left", stereo = True)
-    main(name = "stereo_position4_left", stereo = True)
-    main(name = "mono_position1_left", stereo = False)
-    main(name = "mono_position2_left", stereo = False)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = "Calculate objects' distance of every stereo pair under the input folders")
+    parser.add_argument("folders", nargs = "*", default = ["assets/stereo", "assets/mono"],
+                        help = "folders containing *left.jpg/*right.jpg pairs")
+    parser.add_argument("--output", default = "outputs/", help = "folder of the outputs")
+    parser.add_argument("--rig", choices = ["auto", "stereo", "mono"], default = "auto",
+                        help = "camera rig of the pairs, guessed from their path by default")
+    parser.add_argument("--workers", type = int, default = None, help = "# of processes (default: all cores)")
+    parser.add_argument("--chunksize", type = int, default = 1, help = "# of pairs sent to a process at once")
+    parser.add_argument("--manifest", default = None, help = "JSON-lines manifest (default: <output>/manifest.jsonl)")
+    parser.add_argument("--no-resume", dest = "resume", action = "store_false",
+                        help = "process the pairs whose outputs are up to date again")
+    parser.add_argument("--float32", action = "store_true",
+                        help = "compute the maps in float32 into work buffers reused across pairs")
+    parser.add_argument("--band-budget", type = int, default = None, metavar = "MB",
+                        help = "match the pairs larger than 720p at their resolution by bands within this memory budget")
+    parser.add_argument("--rectify-mode", choices = ["sift", "orb"], default = "sift",
+                        help = "features the mono rig is rectified with (orb is faster, sift more accurate)")
+    args = parser.parse_args()
+
+    output = os.path.join(args.output, "")
+    band_budget = args.band_budget * 2 ** 20 if args.band_budget else None
+    processed, skipped, failed = batch(args.folders, output, args.rig, args.workers, args.chunksize, args.manifest,
+                                       args.resume, args.float32, band_budget, args.rectify_mode)
+    print("Processed %d pair(s), skipped %d up-to-date pair(s), %d failed (retried on resume)"
+          % (processed, skipped, failed))
@@ -1,32 +1,75 @@
+import time
+import queue
+import argparse
+import threading
 import cv2 as cv
 import numpy as np
-from matplotlib import pyplot as plt
 
-from utils.helpers import merge_range, draw_text, normalize
-from utils.disparity import return_disparity, combine_disparity, return_ranges
-from utils.depth import display_individual_depth
+from utils.helpers import draw_text, normalize, BufferArena
+from utils.disparity import compute_pyramid, DisparityHistogram, IncrementalDisparity, DeadlineScheduler, RoiDisparity
+from utils.depth import detect_objects, load_depth_luts
+from utils.capture import LatestQueue, StereoCapture, VideoSource, ImageSource
+from utils.sinks import WindowSink, VideoSink, ImageSink, NullSink
+from utils.archive import DepthWriter
+from utils.camera import load_camera
+from utils.metrics import METRICS, MetricsLog, draw_overlay
 
-def display_depth(imgL, imgR, stereo):
+def compute_depth(imgL, imgR, stereo, camera, incremental = None, archive = None, arena = None, scheduler = None,
+                  roi = None):
+    """
+    Return the annotated disparity map and image of a pair of frames.
+    If `incremental` is an `IncrementalDisparity`, only the tiles changed since its previous frame are recomputed.
+    If `scheduler` is a `DeadlineScheduler`, only the levels of its current quality tier are computed,
+    and the frame's latency chooses the tier of the next frame.
+    If `roi` is a `RoiDisparity`, the high and mid levels are only computed around the objects tracked so far.
+    If `archive` is a `DepthWriter`, the combined disparity and the detections are appended to it.
+    If an `arena` (see utils/helpers.py) is given, the maps are float32 and their buffers are reused across frames.
+    """
+    start = time.perf_counter()
+    
+    # Disparity-to-cm lookup table of the rig
+    lut = load_depth_luts(camera)["stereo" if stereo else "mono"]
+    
     # Convert to grayscale
-    gray_imgL = cv.cvtColor(imgL, cv.COLOR_BGR2GRAY)
-    gray_imgR = cv.cvtColor(imgR, cv.COLOR_BGR2GRAY)
+    with METRICS.stage("grayscale"):
+        gray_imgL = cv.cvtColor(imgL, cv.COLOR_BGR2GRAY)
+        gray_imgR = cv.cvtColor(imgR, cv.COLOR_BGR2GRAY)
 
     # Calculate disparity
-    hi, mid, low = return_disparity(gray_imgL, gray_imgR)
+    dtype = np.float32 if arena is not None else np.float64
+    with METRICS.stage("disparity"):
+        if incremental is not None:
+            pyramid = incremental.compute(gray_imgL, gray_imgR, dtype, arena)
+        elif scheduler is not None:
+            pyramid = scheduler.compute(gray_imgL, gray_imgR, dtype, arena)
+        elif roi is not None:
+            pyramid = roi.compute(gray_imgL, gray_imgR, dtype, arena)
+        else:
+            pyramid = compute_pyramid(gray_imgL, gray_imgR, parallel = True, dtype = dtype, arena = arena)
 
-    # Specify the dectected ranges
-    range_low = return_ranges(low, 0.25, 1.25, 10, 50000)
-    range_mid_high = merge_range(return_ranges(low, 0.05, 0.25, 2, 50000))
+    # Specify the dectected ranges (from one histogram of the native 180p disparity)
+    with METRICS.stage("ranges"):
+        histogram = DisparityHistogram(pyramid.native("low"), dim = pyramid.dim)
+        range_low = histogram.ranges(0.25, 1.25, 10, 50000)
+        range_mid_high = histogram.ranges(0.05, 0.25, 2, 50000, merge = True)
 
     # Combine
-    combined = combine_disparity(gray_imgL.shape[::-1], low, mid, hi, range_mid_high)
+    with METRICS.stage("fusion"):
+        combined = pyramid.combine(range_mid_high)
     
     # Create canvas for visualization
     canvas_dispar = normalize(combined)
     canvas_img = imgL.copy()
 
-    for dispar_range in range_low:
-        x_left, y_top, x_right, y_bot, value = display_individual_depth(combined, dispar_range, stereo)
+    with METRICS.stage("contours"):
+        detections = detect_objects(combined, range_low, lut)
+    if roi is not None:
+        with METRICS.stage("tracking"):
+            roi.track(detections)
+    if archive is not None:
+        with METRICS.stage("archive"):
+            archive.append(combined, detections)
+    for x_left, y_top, x_right, y_bot, value in detections[['x_left', 'y_top', 'x_right', 'y_bot', 'depth']].tolist():
 
         # Put text on disparity image
         draw_text(canvas_dispar, "Object at %.2f cm" % value, (x_left + 5, y_top - 10), text_color = (1, 1, 1))
@@ -42,35 +85,278 @@ def display_depth(imgL, imgR, stereo):
             cv.putText(canvas_img, "WARNING: Object closer than 50cm!",
                        (50, 50), 1, 2, (0, 0, 255), 2, 2)
     
+    # Show the fraction of the tiles that have been recomputed
+    if incremental is not None:
+        draw_text(canvas_dispar, "Recomputed: %d%% of tiles" % round(100 * incremental.fraction), (50, 680),
+                  text_color = (1, 1, 1))
+    
+    # Show the fraction of the frame matched at the high and mid levels
+    if roi is not None:
+        draw_text(canvas_dispar, "ROI: %d%% of the frame, %d object(s) tracked" % (round(100 * roi.fraction),
+                  len(roi.tracks)), (50, 680), text_color = (1, 1, 1))
+    
+    # Show the quality tier of the frame, then choose the next one
+    if scheduler is not None:
+        draw_text(canvas_dispar, "Quality: %s (%s)" % (scheduler.tier, ", ".join(scheduler.tiers[scheduler.tier])),
+                  (50, 650), text_color = (1, 1, 1))
+        scheduler.update(time.perf_counter() - start)
+    
+    return canvas_dispar, canvas_img
+
+
+def display_depth(imgL, imgR, stereo, camera, incremental = None, sink = None):
+    """
+    Compute the depth of a pair of frames and show it, or write it to a sink (see `utils.sinks`).
+    The `camera` model (see utils/camera.py) is loaded once by the caller, not for every frame.
+    Return False if the sink asks to stop.
+    """
+    canvas_dispar, canvas_img = compute_depth(imgL, imgR, stereo, camera, incremental)
+    
+    # Write the result to the sink
+    if sink is not None:
+        return sink.write(canvas_dispar, canvas_img)
+    
     # Displaying the result
     cv.imshow("Disparity", canvas_dispar)
     cv.imshow("Real-life", canvas_img)
     
+    return True
+    
 
-def main():
-    CamL = cv.VideoCapture(2) # Camera ID for left camera
-    CamR = cv.VideoCapture(0) # Camera ID for right camera
+def worker(capture, results, stereo, camera, stop, incremental = None, archive = None, float32 = False,
+           scheduler = None, roi = None):
+    """
+    Compute the depth of the latest synchronized pair until stopped
+    """
+    arena = BufferArena() if float32 else None
+    fractions = []
+    while not stop.is_set():
+        try:
+            with METRICS.stage("capture"):
+                imgL, imgR, _ = capture.read(timeout = 0.1)
+        except queue.Empty:
+            continue
+        
+        with METRICS.stage("compute"):
+            results.put(compute_depth(imgL, imgR, stereo, camera, incremental, archive, arena, scheduler, roi))
+        if incremental is not None:
+            fractions.append(incremental.fraction)
+            
+    report_fractions(fractions)
+    if scheduler is not None:
+        report_tiers(scheduler)
+        
+
+def report_fractions(fractions):
+    """
+    Report the mean fraction of the tiles that have been recomputed per frame
+    """
+    if fractions:
+        print("Recomputed %.1f%% of the tiles per frame on average over %d frames"
+              % (100 * sum(fractions) / len(fractions), len(fractions)))
+        
+
+def report_tiers(scheduler):
+    """
+    Report the # of frames computed at every quality tier
+    """
+    print("Frames per quality tier within %.0f ms: %s" % (1000 * scheduler.budget,
+          ", ".join("%s %d" % (tier, count) for tier, count in scheduler.counts.items())))
+        
+
+def run(source, sink, stereo, camera, incremental = None, overlay = False, log = None, archive = None,
+        float32 = False, scheduler = None, roi = None):
+    """
+    Compute the depth of every pair of a source on the calling thread, as fast as possible,
+    until the source ends, the sink asks to stop or Ctrl+C is pressed.
+    Return the # of processed pairs and the elapsed time (s).
+    """
+    arena = BufferArena() if float32 else None
+    processed, start, fractions = 0, time.perf_counter(), []
+    try:
+        while True:
+            try:
+                with METRICS.stage("capture"):
+                    imgL, imgR, _ = source.read(timeout = 0.1)
+            except queue.Empty:
+                continue
+            except EOFError:
+                break
+            
+            with METRICS.stage("compute"):
+                canvas_dispar, canvas_img = compute_depth(imgL, imgR, stereo, camera, incremental, archive, arena,
+                                                          scheduler, roi)
+            if incremental is not None:
+                fractions.append(incremental.fraction)
+            if overlay:
+                draw_overlay(canvas_img, METRICS)
+            with METRICS.stage("sink"):
+                running = sink.write(canvas_dispar, canvas_img)
+            METRICS.tick()
+            processed += 1
+            
+            if log is not None:
+                log.write()
+            if not running:
+                break
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.perf_counter() - start
     
-    while True:
-        # Capturing and storing left and right camera images
-        retL, imgL = CamL.read()
-        retR, imgR = CamR.read()
+    report_fractions(fractions)
+    if scheduler is not None:
+        report_tiers(scheduler)
+    
+    return processed, elapsed
+
+
+def open_source(video = None, images = None):
+    """
+    Return the frame source: a recorded video (side-by-side, or one per camera), an image sequence or the live cameras
+    """
+    if video:
+        return VideoSource(*video)
+    if images:
+        return ImageSource(images)
+    
+    # Camera ID for left and right camera, frames are captured natively at 1280x720
+    return StereoCapture(left_id = 2, right_id = 0, dim = (1280, 720))
+
+
+def open_sink(kind = "window", output = None):
+    """
+    Return the sink of the results: "window", "video", "images" or "null"
+    """
+    if kind == "video":
+        return VideoSink(output or "outputs/realtime.mp4")
+    if kind == "images":
+        return ImageSink(output or "outputs/realtime/")
+    
+    return NullSink() if kind == "null" else WindowSink()
+
+
+def main(incremental = False, refresh = 30, threshold = 8, overlay = False, metrics = None,
+         source = None, sink = None, headless = False, archive = None, compress = False, float32 = False,
+         budget = None, roi = False):
+    """
+    Display the objects' distance of the stereo rig until "q" is pressed.
+    If `overlay` is True or `metrics` is a .csv/.jsonl path, the running time of every stage is measured,
+    shown on the image and/or written to the file every second.
+    If a `source` (see `utils.capture`), a `sink` (see `utils.sinks`) or `headless` is given, every pair
+    is processed on the main thread and the achieved throughput is reported.
+    If `archive` is a folder, the combined disparity and the detections of every frame are appended to it
+    (see `utils.archive`), its full chunks being compressed if `compress` is True.
+    If `float32` is True, the maps are computed in float32 into work buffers reused across frames.
+    If `budget` is a latency (ms), the quality tier of every frame is chosen to fit it (see `DeadlineScheduler`).
+    If `roi` is True, the high and mid levels are only computed around the tracked objects (see `RoiDisparity`).
+    """
+    if overlay or metrics:
+        METRICS.enabled = True
+    log = MetricsLog(metrics) if metrics else None
+    camera = load_camera()
+    disparity = IncrementalDisparity(threshold = threshold, refresh = refresh) if incremental else None
+    scheduler = DeadlineScheduler(budget / 1000) if budget else None
+    roi = RoiDisparity() if roi else None
+    if archive:
+        archive = DepthWriter(archive, (720, 1280), compress = compress, attrs = {"stereo": True, "camera": camera.digest})
+    
+    # Process every pair of the source without the live GUI
+    if source is not None or sink is not None or headless:
+        source = (source if source is not None else open_source()).start()
+        sink = sink if sink is not None else NullSink()
+        processed, elapsed = run(source, sink, True, camera, disparity, overlay, log, archive, float32, scheduler,
+                                 roi)
+        source.stop()
+        sink.close()
+        if log is not None:
+            log.close()
+        if archive is not None:
+            archive.close()
         
-        # Resize to 1280x720
-        fixed_dim = (1280, 720)
-        imgL, imgR = cv.resize(imgL, fixed_dim), cv.resize(imgR, fixed_dim)
+        print("Processed %d pairs in %.2f s (%.2f pairs/s)" % (processed, elapsed, processed / max(elapsed, 1e-9)))
+        return
+    
+    capture = open_source().start()
+    
+    # Compute on a separate thread, the GUI stays on the main thread
+    results, stop = LatestQueue(), threading.Event()
+    compute = threading.Thread(target = worker, daemon = True,
+                               args = (capture, results, True, camera, stop, disparity, archive, float32, scheduler,
+                                       roi))
+    compute.start()
+    
+    displayed = 0
+    while True:
+        # Display the latest result
+        try:
+            canvas_dispar, canvas_img = results.get(timeout = 0.01)
+            if overlay:
+                draw_overlay(canvas_img, METRICS)
+            with METRICS.stage("imshow"):
+                cv.imshow("Disparity", canvas_dispar)
+                cv.imshow("Real-life", canvas_img)
+            METRICS.tick()
+            displayed += 1
+        except queue.Empty:
+            pass
         
-        # Proceed only if the frames have been capture
-        if retL and retR:
-            display_depth(imgL, imgR, stereo = True)
+        if log is not None:
+            log.write()
  
-        # Wait for 10ms before displaying the next frame
-        key = cv.waitKey(10)
+        # Wait for 1ms to let the windows refresh
+        key = cv.waitKey(1)
         if key == ord('q'):
             break
-    else:
-        CamL = cv.VideoCapture(2)
-        CamR = cv.VideoCapture(0)
-            
+    
+    # Stop every thread
+    stop.set()
+    compute.join()
+    capture.stop()
+    if log is not None:
+        log.close()
+    if archive is not None:
+        archive.close()
+    
+    # Report the skipped frames
+    stats = capture.stats()
+    print("Captured %d pairs, displayed %d, skipped %d before computing and %d before displaying"
+          % (stats["captured"], displayed, stats["skipped"], results.skipped))
+    
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description = "Display the objects' distance of a live stereo rig")
+    parser.add_argument("--incremental", action = "store_true",
+                        help = "only recompute the disparity of the tiles that have changed since the previous frame")
+    parser.add_argument("--refresh", type = int, default = 30, help = "# of frames between two full computations")
+    parser.add_argument("--threshold", type = float, default = 8,
+                        help = "mean gray-level difference above which a tile is recomputed")
+    parser.add_argument("--overlay", action = "store_true", help = "show the frame rate and the running time of every stage")
+    parser.add_argument("--metrics", default = None,
+                        help = "write the running time of every stage every second to a .csv or .jsonl file")
+    parser.add_argument("--video", nargs = "+", default = None, metavar = "VIDEO",
+                        help = "read a side-by-side video, or the left and right videos, instead of the cameras")
+    parser.add_argument("--images", default = None, help = "read the *left.jpg/*right.jpg pairs of a folder instead of the cameras")
+    parser.add_argument("--sink", choices = ["window", "video", "images", "null"], default = None,
+                        help = "where the results go (default: window, or null if headless)")
+    parser.add_argument("--output", default = None, help = "output video or folder of the video and images sinks")
+    parser.add_argument("--headless", action = "store_true", help = "never open a window and process the pairs as fast as possible")
+    parser.add_argument("--archive", default = None,
+                        help = "folder where the disparity and the detections of every frame are appended")
+    parser.add_argument("--compress", action = "store_true", help = "compress the full chunks of the archive")
+    parser.add_argument("--float32", action = "store_true", help = "compute the maps in float32 into reused work buffers")
+    parser.add_argument("--budget", type = float, default = None,
+                        help = "latency budget (ms) of a frame, the levels computed are chosen to fit it")
+    parser.add_argument("--roi", action = "store_true",
+                        help = "only compute the 720p and 360p disparity around the tracked objects")
+    args = parser.parse_args()
+    
+    if args.video is not None and len(args.video) > 2:
+        parser.error("--video takes a side-by-side video or a left and a right video")
+    if sum([args.incremental, args.budget is not None, args.roi]) > 1:
+        parser.error("--incremental, --budget and --roi cannot be combined")
+    if args.headless and args.sink == "window":
+        parser.error("--headless cannot show the results in a window")
+    source = open_source(args.video, args.images) if args.video or args.images else None
+    sink = open_sink(args.sink, args.output) if args.sink else None
+    main(args.incremental, args.refresh, args.threshold, args.overlay, args.metrics, source, sink, args.headless,
+         args.archive, args.compress, args.float32, args.budget, args.roi)
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import numpy as np
+
+# Fixed-point scale of the uint16 maps: disparities in [0, 2) with a 1/32768 resolution
+DISPARITY_SCALE = 2 ** 15
+
+def chunk_path(path, chunk, compressed = False):
+    """
+    Return the file of a chunk of an archive
+    """
+    return os.path.join(path, "chunk_%05d.%s" % (chunk, "npz" if compressed else "npy"))
+
+
+def encode(values, dtype, scale):
+    """
+    Convert float maps to the archive's dtype, the negative and NaN values (invalid) become 0
+    """
+    if dtype == np.float16:
+        return values.astype(np.float16)
+
+    fixed = np.nan_to_num(values * scale, nan = 0.0)
+    return np.clip(fixed, 0, np.iinfo(dtype).max, out = fixed).round().astype(dtype)
+
+
+def detection_records(detections):
+    """
+    Convert the detections (see `utils.depth.detect_objects`) to JSON records
+    """
+    if detections is None:
+        return []
+    names = detections.dtype.names
+
+    return [dict(zip(names, row)) for row in detections.tolist()]
+
+
+class DepthWriter:
+    def __init__(self, path, shape, dtype = "uint16", scale = DISPARITY_SCALE, chunk_size = 64, compress = False,
+                 attrs = None):
+        """
+        Append-only archive of a sequence of disparity or depth maps and their detections.
+        The maps are stored in preallocated memory-mapped chunks of `chunk_size` frames,
+        every frame is listed in "index.jsonl" once its map is written.
+
+        Params:
+            path (str): folder of the archive, appended to if it already exists
+            shape ((int, int)): (height, width) of the maps
+            dtype (str): "uint16" (fixed point) or "float16"
+            scale (float): fixed-point scale of the uint16 maps, i.e. value = stored / scale
+            chunk_size (int): # of frames per chunk
+            compress (bool): if True, every full chunk is compressed (its frames are then read with a copy)
+            attrs (dict): extra metadata, e.g. the rig and the camera's digest
+        """
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+        meta_path = os.path.join(path, "archive.json")
+
+        if os.path.exists(meta_path):
+            with open(meta_path) as file:
+                self.meta = json.load(file)
+        else:
+            self.meta = {"shape": list(shape), "dtype": np.dtype(dtype).name, "scale": scale,
+                         "chunk_size": chunk_size, "compress": compress, "attrs": attrs or {}}
+            with open(meta_path, "w") as file:
+                json.dump(self.meta, file, indent = 2)
+
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.count = len(read_index(path))
+        self.index = open(os.path.join(path, "index.jsonl"), "a")
+        self.chunk, self.frames = None, None
+
+
+    def open_chunk(self, chunk):
+        """
+        Return the memory map of a chunk, created on its first frame
+        """
+        path = chunk_path(self.path, chunk)
+        shape = (self.meta["chunk_size"], *self.meta["shape"])
+        if os.path.exists(path):
+            return np.load(path, mmap_mode = "r+")
+
+        return np.lib.format.open_memmap(path, mode = "w+", dtype = self.dtype, shape = shape)
+
+
+    def close_chunk(self):
+        """
+        Flush the current chunk, and compress it if it is full
+        """
+        if self.frames is None:
+            return
+        self.frames.flush()
+
+        full = self.count % self.meta["chunk_size"] == 0
+        if self.meta["compress"] and full:
+            np.savez_compressed(chunk_path(self.path, self.chunk, True), frames = self.frames)
+            del self.frames
+            os.remove(chunk_path(self.path, self.chunk))
+        self.chunk, self.frames = None, None
+
+
+    def append(self, values, detections = None, timestamp = None):
+        """
+        Append a map and its detections, return the frame's # in the archive
+        """
+        if values.shape != tuple(self.meta["shape"]):
+            raise ValueError("Expected a map of shape %s, got %s" % (tuple(self.meta["shape"]), values.shape))
+
+        chunk, offset = divmod(self.count, self.meta["chunk_size"])
+        if chunk != self.chunk:
+            self.close_chunk()
+            self.chunk, self.frames = chunk, self.open_chunk(chunk)
+        self.frames[offset] = encode(values, self.dtype, self.meta["scale"])
+
+        # List the frame once its map is written
+        record = {"frame": self.count, "time": time.time() if timestamp is None else timestamp,
+                  "chunk": chunk, "offset": offset, "detections": detection_records(detections)}
+        self.index.write(json.dumps(record) + "\n")
+        self.index.flush()
+        self.count += 1
+
+        # Finish the chunk as soon as it is full
+        if offset + 1 == self.meta["chunk_size"]:
+            self.close_chunk()
+
+        return record["frame"]
+
+
+    def close(self):
+        """
+        Flush the current chunk and close the index
+        """
+        self.close_chunk()
+        self.index.close()
+
+
+def read_index(path):
+    """
+    Return the records of every frame of an archive
+    """
+    index = os.path.join(path, "index.jsonl")
+    if not os.path.exists(index):
+        return []
+    with open(index) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+class DepthArchive:
+    def __init__(self, path):
+        """
+        Random access to the frames of an archive written by `DepthWriter`, without copy if it is not compressed
+        """
+        self.path = path
+        with open(os.path.join(path, "archive.json")) as file:
+            self.meta = json.load(file)
+        self.records = read_index(path)
+        self.chunks = {}
+
+
+    def __len__(self):
+        """
+        Return the # of frames
+        """
+        return len(self.records)
+
+
+    def load_chunk(self, chunk):
+        """
+        Return the frames of a chunk, memory-mapped, or decompressed once if the chunk is compressed
+        """
+        if chunk not in self.chunks:
+            path = chunk_path(self.path, chunk)
+            if os.path.exists(path):
+                self.chunks[chunk] = np.load(path, mmap_mode = "r")
+            else:
+                # Only keep the latest decompressed chunk in memory
+                self.chunks = {key: value for key, value in self.chunks.items() if isinstance(value, np.memmap)}
+                with np.load(chunk_path(self.path, chunk, True)) as file:
+                    self.chunks[chunk] = file["frames"]
+
+        return self.chunks[chunk]
+
+
+    def raw(self, frame):
+        """
+        Return the stored map of a frame, a read-only view of the file
+        """
+        record = self.records[frame]
+
+        return self.load_chunk(record["chunk"])[record["offset"]]
+
+
+    def __getitem__(self, frame):
+        """
+        Return the map of a frame as float32, the invalid values being NaN for uint16 maps
+        """
+        raw = self.raw(frame)
+        if raw.dtype == np.float16:
+            return raw.astype(np.float32)
+
+        values = raw.astype(np.float32)
+        values /= self.meta["scale"]
+        values[raw == 0] = np.nan
+
+        return values
+
+
+    def detections(self, frame):
+        """
+        Return the detections of a frame as dicts of DETECTION_DTYPE's fields
+        """
+        return self.records[frame]["detections"]
+
+
+    def timestamp(self, frame):
+        """
+        Return the time (s since the epoch) of a frame
+        """
+        return self.records[frame]["time"]
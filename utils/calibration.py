@@ -1,12 +1,37 @@
 # Import libraries
-from matplotlib import pyplot as plt
 import numpy as np
 import cv2 as cv
+import os
 import glob
+import hashlib
+from multiprocessing import Pool
 import yaml
 
+# Termination criteria of the corner refinement
+CRITERIA = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+def find_corners(fname, nx, ny):
+    """
+    Find and refine the chessboard corners of an image
+    
+    Returns:
+        (np.ndarray): the corners, or None if the chessboard is not found
+    """
+    # Read image as grayscale
+    img = cv.cvtColor(cv.imread(fname), cv.COLOR_BGR2GRAY)
+    
+    # Find the chess board corners
+    ret, corners = cv.findChessboardCorners(img, (nx, ny), None)
+    if not ret:
+        return None
+    
+    # Refine corner
+    cv.cornerSubPix(img, corners, (11,11), (-1,-1), CRITERIA)
+    
+    return corners
+
 class Calibration:
-    def __init__(self, camera, chess_type = '.jpg', nx = 9, ny = 6): 
+    def __init__(self, camera, chess_type = '.jpg', nx = 9, ny = 6, workers = None): 
         """
         Create a new instance of the Calibration class accordingly to the input
         
@@ -15,14 +40,23 @@ class Calibration:
             img_type (str): the type of input images
             nx (int): # of rows of the printed chessboard
             ny (int): # of cols of the printed chessboard
+            workers (int): # of processes detecting the corners, all cores if None
         """
         # Locate the optional chessboard references
         self.folder = "../assets/chessboard/" + camera + "/"
         self.chess_type = chess_type
         self.dimensions = [1280, 720]
+        self.workers = workers
         
         # Specify the # of rows and cols of the printed chessboard
         self.nx, self.ny = nx, ny
+        
+        # Corners already detected, keyed by image content and chessboard size
+        self.cache_file = "../outputs/corners_" + camera + ".npz"
+        self.cache = self.load_cache()
+        
+        # Cache keys of the images in the calibration set
+        self.keys = set()
 
         # Object points and image points from all the images
         self.objpoints, self.imgpoints, self.temp_img = self.read_imgs()
@@ -42,29 +76,120 @@ class Calibration:
         """
         # Specify the input and output
         images = glob.glob(self.folder + "*" + self.chess_type)
-        objpoints, imgpoints = [], []
+        objpoints, imgpoints = self.detect(self.new_images(images))
+        img = cv.cvtColor(cv.imread(images[-1]), cv.COLOR_BGR2GRAY)
 
-        # Prepare object points
-        objp = np.zeros((self.nx * self.ny, 3), np.float32)
-        objp[:,:2] = np.mgrid[0:self.nx, 0:self.ny].T.reshape(-1,2)
-        
-        # Termination criteria
-        criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+        return objpoints, imgpoints, img
+    
+    
+    def new_images(self, images) -> dict:
+        """
+        Return the images that are not in the calibration set yet, keyed by their cache key,
+        and add them to the set (an image added twice, even under another name, only counts once)
 
+        Params:
+            images (list): paths of the images
+        """
+        new = {}
         for fname in images:
-            # Read image as grayscale
-            img = cv.cvtColor(cv.imread(fname), cv.COLOR_BGR2GRAY)
+            key = self.cache_key(fname)
+            if key not in self.keys and key not in new:
+                new[key] = fname
+        self.keys.update(new)
+        
+        return new
+    
+    
+    def detect(self, images) -> (list, list):
+        """
+        Find the chessboard corners of the images, only processing those that are not cached yet
 
-            # Find the chess board corners
-            ret, corners = cv.findChessboardCorners(img, (self.nx, self.ny), None)
+        Params:
+            images (dict): paths of the images, keyed by their cache key (see `new_images`)
 
-            # If found, add object points, image points
-            if ret == True:
+        Returns:
+            objpoints (list): 3D points in real world
+            imgpoints (list): 2D points in image plane
+        """
+        # Prepare object points
+        objp = np.zeros((self.nx * self.ny, 3), np.float32)
+        objp[:,:2] = np.mgrid[0:self.nx, 0:self.ny].T.reshape(-1,2)
+        
+        # Find the images that are new or have changed
+        keys = list(images)
+        missing = [(fname, key) for key, fname in images.items() if key not in self.cache]
+        
+        # Detect their corners on a process pool
+        if missing:
+            args = [(fname, self.nx, self.ny) for fname, _ in missing]
+            if len(missing) > 1 and self.workers != 1:
+                with Pool(self.workers) as pool:
+                    results = pool.starmap(find_corners, args)
+            else:
+                results = [find_corners(*arg) for arg in args]
+            
+            # An empty array marks an image without chessboard
+            for (_, key), corners in zip(missing, results):
+                self.cache[key] = corners if corners is not None else np.empty((0, 1, 2), np.float32)
+            self.save_cache()
+            
+        # If found, add object points, image points
+        objpoints, imgpoints = [], []
+        for key in keys:
+            if len(self.cache[key]) > 0:
                 objpoints.append(objp)
-                cv.cornerSubPix(img, corners, (11,11), (-1,-1), criteria) # Refine corner
-                imgpoints.append(corners)
+                imgpoints.append(self.cache[key])
 
-        return objpoints, imgpoints, img
+        return objpoints, imgpoints
+    
+    
+    def cache_key(self, fname) -> str:
+        """
+        Return the cache key of an image: hash of its content and the chessboard size
+        """
+        with open(fname, 'rb') as file:
+            digest = hashlib.sha1(file.read()).hexdigest()
+        
+        return "%s_%dx%d" % (digest, self.nx, self.ny)
+    
+    
+    def load_cache(self) -> dict:
+        """
+        Load the corners cached by previous calibrations
+        """
+        if not os.path.exists(self.cache_file):
+            return {}
+        
+        with np.load(self.cache_file) as data:
+            return {key: data[key] for key in data.files}
+        
+        
+    def save_cache(self):
+        """
+        Save the detected corners
+
+        Side-effects:
+            Write a new .npz file to the default folder
+        """
+        np.savez(self.cache_file, **self.cache)
+        
+        
+    def add_images(self, images):
+        """
+        Add new chessboard images and calibrate the camera again, without reading the previous images.
+        The images already in the calibration set are skipped.
+        
+        Params:
+            images (list): paths of the new images
+        """
+        objpoints, imgpoints = self.detect(self.new_images(images))
+        if not objpoints:
+            return
+        self.objpoints += objpoints
+        self.imgpoints += imgpoints
+        
+        # Camera's parameters
+        self.mtx, self.dist, self.rvecs, self.tvecs = self.calibrate()
 
     
     def calibrate(self) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
@@ -140,13 +265,15 @@ class Calibration:
         Returns:
             (float): the total error of the calibration
         """
-        mean_error = 0
-        for i in range(len(self.objpoints)):
-            imgpoints2, _ = cv.projectPoints(self.objpoints[i], self.rvecs[i], self.tvecs[i], self.mtx, self.dist)
-            error = cv.norm(self.imgpoints[i], imgpoints2, cv.NORM_L2) / len(imgpoints2)
-            mean_error += error
+        # Project the object points of every image
+        imgpoints2 = np.array([cv.projectPoints(self.objpoints[i], self.rvecs[i], self.tvecs[i], self.mtx, self.dist)[0]
+                               for i in range(len(self.objpoints))])
+        
+        # Mean of the L2 error of every image, divided by its # of points
+        diff = np.array(self.imgpoints, dtype = np.float64) - imgpoints2
+        errors = np.sqrt(np.sum(diff ** 2, axis = (1, 2, 3))) / imgpoints2.shape[1]
 
-        return mean_error / len(self.objpoints)
+        return float(np.mean(errors))
     
 
     def export_params(self, filename = "cam"):
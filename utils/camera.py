@@ -0,0 +1,65 @@
+import os
+import hashlib
+from dataclasses import dataclass
+import numpy as np
+import yaml
+
+@dataclass(frozen = True)
+class CameraModel:
+    """
+    Camera's parameters read from a calibration file, loaded once and passed to the pipeline
+
+    Params:
+        path (str): the calibration file
+        mtime (int): modification time (ns) of the file when it was loaded
+        digest (str): SHA-1 digest of the file's content
+        focal (float): the focal length used to convert disparity to depth
+        intrinsic (np.ndarray): camera's intrinsic matrix
+        distortion (np.ndarray): distortion coefficients
+        baseline_stereo (float): baseline (cm) of the stereo rig
+        baseline_mono (float): baseline (cm) of the mono rig, i.e. the camera's shift distance
+    """
+    path: str
+    mtime: int
+    digest: str
+    focal: float
+    intrinsic: np.ndarray
+    distortion: np.ndarray
+    baseline_stereo: float = 9
+    baseline_mono: float = 5
+
+    def baseline(self, stereo):
+        """
+        Return the baseline (cm) of the stereo or mono rig
+        """
+        return self.baseline_stereo if stereo else self.baseline_mono
+
+
+def read_camera(path):
+    """
+    Read a calibration file into a new camera model
+    """
+    mtime = os.stat(path).st_mtime_ns
+    with open(path, 'rb') as file:
+        content = file.read()
+    params = yaml.safe_load(content)
+
+    # Make the matrices read-only
+    intrinsic, distortion = np.array(params["camera_matrix"]), np.array(params["distort_coeff"])
+    intrinsic.flags.writeable = distortion.flags.writeable = False
+
+    return CameraModel(path, mtime, hashlib.sha1(content).hexdigest(), float(params["focal_cm"]), intrinsic, distortion)
+
+
+# Camera models already loaded by this process, keyed by their file
+_CAMERAS = {}
+
+def load_camera(path = 'outputs/left.yaml'):
+    """
+    Return the camera model of a calibration file, read again only if the file has changed
+    """
+    camera = _CAMERAS.get(path)
+    if camera is None or os.stat(path).st_mtime_ns != camera.mtime:
+        camera = _CAMERAS[path] = read_camera(path)
+
+    return camera
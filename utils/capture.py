@@ -0,0 +1,264 @@
+import os
+import glob
+import time
+import queue
+import threading
+import cv2 as cv
+
+class LatestQueue:
+    def __init__(self, maxsize = 1):
+        """
+        Bounded queue where a new item replaces the oldest one when the queue is full
+
+        Params:
+            maxsize (int): maximum # of items waiting in the queue
+        """
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+
+    def put(self, item):
+        """
+        Add an item, dropping the oldest one if the queue is full
+        """
+        with self.lock:
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.skipped += 1
+                    except queue.Empty:
+                        pass
+
+
+    def get(self, timeout = None):
+        """
+        Remove and return the oldest item, raise queue.Empty after `timeout` seconds
+        """
+        return self.queue.get(timeout = timeout)
+
+
+def open_camera(camera_id, dim = (1280, 720)):
+    """
+    Open a camera and ask its driver for the input resolution
+    """
+    camera = cv.VideoCapture(camera_id)
+    camera.set(cv.CAP_PROP_FRAME_WIDTH, dim[0])
+    camera.set(cv.CAP_PROP_FRAME_HEIGHT, dim[1])
+    camera.set(cv.CAP_PROP_BUFFERSIZE, 1) # Only keep the latest frame in the driver
+
+    return camera
+
+
+class StereoCapture:
+    def __init__(self, left_id = 2, right_id = 0, dim = (1280, 720), maxsize = 1):
+        """
+        Capture synchronized frames of a left and a right camera, one grabber thread per camera
+
+        Params:
+            left_id (int): camera ID of the left camera
+            right_id (int): camera ID of the right camera
+            dim ((int, int)): resolution (width, height) of the frames
+            maxsize (int): # of pairs waiting to be processed before the oldest one is skipped
+        """
+        self.dim = dim
+        self.cameras = [open_camera(left_id, dim), open_camera(right_id, dim)]
+        self.pairs = LatestQueue(maxsize)
+        self.captured = 0
+
+        # Both grabbers wait for each other before grabbing and after retrieving a frame
+        self.frames = [None, None]
+        self.barrier = threading.Barrier(2)
+        self.running = threading.Event()
+        self.threads = []
+
+
+    def start(self):
+        """
+        Start the grabber threads
+        """
+        self.running.set()
+        self.threads = [threading.Thread(target = self.grabber, args = (i,), daemon = True) for i in range(2)]
+        for thread in self.threads:
+            thread.start()
+
+        return self
+
+
+    def grabber(self, index):
+        """
+        Grab and retrieve frames of one camera until the capture is stopped
+        """
+        camera = self.cameras[index]
+
+        while self.running.is_set():
+            try:
+                # Grab both frames at the same time, then decode them
+                self.barrier.wait()
+                ret = camera.grab()
+                timestamp = time.monotonic()
+                ret, frame = camera.retrieve() if ret else (False, None)
+
+                # Resize only if the driver ignored the requested resolution
+                if ret and (frame.shape[1], frame.shape[0]) != self.dim:
+                    frame = cv.resize(frame, self.dim)
+                self.frames[index] = (ret, timestamp, frame)
+
+                # One of the grabbers publishes the pair
+                if self.barrier.wait() == 0:
+                    (retL, timeL, imgL), (retR, timeR, imgR) = self.frames
+                    if retL and retR:
+                        self.captured += 1
+                        self.pairs.put((imgL, imgR, abs(timeL - timeR)))
+            except threading.BrokenBarrierError:
+                break
+
+
+    def read(self, timeout = None):
+        """
+        Return the latest synchronized pair (left, right, time difference in seconds)
+        """
+        return self.pairs.get(timeout)
+
+
+    def stop(self):
+        """
+        Stop the grabber threads and release the cameras
+        """
+        self.running.clear()
+        self.barrier.abort()
+        for thread in self.threads:
+            thread.join()
+        for camera in self.cameras:
+            camera.release()
+
+
+    def stats(self):
+        """
+        Return the # of captured pairs and the # of pairs skipped because nobody consumed them in time
+        """
+        return {"captured": self.captured, "skipped": self.pairs.skipped}
+
+
+def fit(frame, dim):
+    """
+    Resize a frame to the dimension (width, height) if it has another one
+    """
+    return frame if (frame.shape[1], frame.shape[0]) == dim else cv.resize(frame, dim)
+
+
+class VideoSource:
+    def __init__(self, left, right = None, dim = (1280, 720)):
+        """
+        Read the pairs of a recorded session, from a side-by-side video or from one video per camera
+
+        Params:
+            left (str): the left camera's video, or the side-by-side video (left half first) if `right` is None
+            right (str): the right camera's video
+            dim ((int, int)): resolution (width, height) of the frames
+        """
+        self.dim = dim
+        paths = [left] + ([right] if right is not None else [])
+        self.videos = [cv.VideoCapture(path) for path in paths]
+        for path, video in zip(paths, self.videos):
+            if not video.isOpened():
+                raise OSError("Cannot open the video %s" % path)
+        self.captured = 0
+
+
+    def start(self):
+        """
+        Nothing to start, the frames are read when asked for
+        """
+        return self
+
+
+    def read(self, timeout = None):
+        """
+        Return the next pair (left, right, time difference in seconds), raise EOFError at the end of a video
+        """
+        frames = []
+        for video in self.videos:
+            ret, frame = video.read()
+            if not ret:
+                raise EOFError("End of the video")
+            frames.append(frame)
+
+        # Split the side-by-side frame
+        if len(frames) == 1:
+            width = frames[0].shape[1] // 2
+            frames = [frames[0][:, :width], frames[0][:, width:2 * width]]
+
+        self.captured += 1
+        return fit(frames[0], self.dim), fit(frames[1], self.dim), 0.0
+
+
+    def stop(self):
+        """
+        Release the videos
+        """
+        for video in self.videos:
+            video.release()
+
+
+    def stats(self):
+        """
+        Return the # of read pairs, a recorded session never skips any
+        """
+        return {"captured": self.captured, "skipped": 0}
+
+
+class ImageSource:
+    def __init__(self, folder, pattern = "*left.jpg", dim = (1280, 720)):
+        """
+        Read the pairs of an image sequence, every left image having a right image named alike
+
+        Params:
+            folder (str): folder searched recursively, the pairs are read in the order of their paths
+            pattern (str): pattern of the left images, "left" is replaced by "right" in the right images' names
+            dim ((int, int)): resolution (width, height) of the frames
+        """
+        self.dim = dim
+        self.pairs = []
+        for left in sorted(glob.glob(os.path.join(folder, "**", pattern), recursive = True)):
+            head, tail = os.path.split(left)
+            right = os.path.join(head, "right".join(tail.rsplit("left", 1)))
+            if os.path.exists(right):
+                self.pairs.append((left, right))
+        self.captured = 0
+
+
+    def start(self):
+        """
+        Nothing to start, the frames are read when asked for
+        """
+        return self
+
+
+    def read(self, timeout = None):
+        """
+        Return the next pair (left, right, time difference in seconds), raise EOFError after the last pair
+        """
+        if self.captured >= len(self.pairs):
+            raise EOFError("End of the image sequence")
+
+        left, right = self.pairs[self.captured]
+        self.captured += 1
+        return fit(cv.imread(left), self.dim), fit(cv.imread(right), self.dim), 0.0
+
+
+    def stop(self):
+        """
+        Nothing to release, the images are read one by one
+        """
+
+
+    def stats(self):
+        """
+        Return the # of read pairs, a recorded session never skips any
+        """
+        return {"captured": self.captured, "skipped": 0}
@@ -1,27 +1,55 @@
+import os
+import re
+import zipfile
+import functools
 import numpy as np
 import cv2 as cv
-import pandas as pd
 import yaml
 
-# Allow realtime.py to run on another device that haven't install pyntcloud 
 try:
-    from pyntcloud import PyntCloud
+    from utils.metrics import METRICS
 except ImportError:
-    pass
+    # Imported from the utils folder, e.g. by finetuning.py
+    from metrics import METRICS
 
-def return_depth(disparity, stereo, this_path = ""):
+# Layout of a point in the exported point cloud (binary little-endian PLY)
+PLY_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                      ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+PLY_TYPES = {'f4': 'float', 'u1': 'uchar'}
+
+# Layout of an object detected by `detect_objects`
+DETECTION_DTYPE = np.dtype([('x_left', 'i4'), ('y_top', 'i4'), ('x_right', 'i4'), ('y_bot', 'i4'), ('area', 'i4'),
+                            ('depth', 'f8'), ('depth_std', 'f8'), ('min_disparity', 'f8'), ('max_disparity', 'f8')])
+
+# Depth (px) measured by utils/finetuning.py for objects at known distances (cm), per rig
+PX_CM_SAMPLES = {"mono": [[50, 50, 85],
+                          [3.86232965, 3.72734804, 6.42447434]],
+                 "stereo": [[50, 70, 100],
+                            [4.72974624, 6.67173753, 9.98931149]]}
+
+@METRICS.timed()
+def return_depth(disparity, stereo, this_path = "", camera = None, out = None):
     """
     Calculate depth map knowing the disparity map, the camera's focal lens, and the baseline.
     Thanks to maths, we can also use this function to calculate disparity map knowing the rest.
+    Pass the `camera` model (see utils/camera.py) to avoid reading the calibration file,
+    and `out` to write the depth map into a preallocated buffer.
     """
-    BASELINE = 9 if stereo else 5 # cm
-    FOCAL_LENGTH = get_focal_px(this_path + 'outputs/left.yaml')  # px/px
+    if camera is not None:
+        BASELINE, FOCAL_LENGTH = camera.baseline(stereo), camera.focal
+    else:
+        BASELINE = 9 if stereo else 5 # cm
+        FOCAL_LENGTH = get_focal_px(this_path + 'outputs/left.yaml')  # px/px
     
     # Cast type of disparity
     disparity = float(disparity) if type(disparity) == int else disparity
     
     # Calculate depth map
-    depth = np.divide(BASELINE * FOCAL_LENGTH, disparity, out = np.zeros_like(disparity), where = disparity != 0.0)
+    if out is None:
+        out = np.zeros_like(disparity)
+    else:
+        out.fill(0)
+    depth = np.divide(BASELINE * FOCAL_LENGTH, disparity, out = out, where = disparity != 0.0)
 
     return depth  # cm
 
@@ -33,67 +61,222 @@ def get_focal_px(path):
     # Get instrinsic matrix
     return float(mtx["focal_cm"])
 
-def px_cm_ratio(depth, stereo = True, from_cm = True):
+def fit_px_cm(samples, from_cm = True):
     """
-    Convert to pixel to cm, and vice versa
+    Fit the line between the cm and pixel values of the samples ([cm values], [px values])
     """
-    # Known matrices
-    single = [[50, 50, 85],
-              [3.86232965, 3.72734804, 6.42447434]]
-    twice = [[50, 70, 100],
-             [4.72974624, 6.67173753, 9.98931149]]
-    
     # Cast x, y according to inputs
-    mtx = twice if stereo else single
-    (y, x) = (mtx[0], mtx[1]) if from_cm else (mtx[1], mtx[0])
+    (y, x) = (samples[0], samples[1]) if from_cm else (samples[1], samples[0])
     
     # Calculate the scalar
     A = np.vstack([y, np.ones(len(y))]).T
     m, c = np.linalg.lstsq(A, x, rcond=-1)[0]
+    
+    return m, c
+
+
+@functools.lru_cache(maxsize = None)
+def px_cm_model(stereo = True, from_cm = True):
+    """
+    Return the (m, c) of the known samples of a rig, fitted once per process
+    """
+    return fit_px_cm(PX_CM_SAMPLES["stereo" if stereo else "mono"], from_cm)
+
+
+def px_cm_ratio(depth, stereo = True, from_cm = True):
+    """
+    Convert to pixel to cm, and vice versa
+    """
+    m, c = px_cm_model(stereo, from_cm)
         
     # Return y = mx + c
     return m * depth + c
 
 
-def depth_to_ply(image, depth, name = "my_pts"):
+def read_finetuning(path = 'outputs/finetuning.txt'):
     """
-    Convert depth map to point cloud
+    Read the depth (px) of the object of every image written by utils/finetuning.py into samples
+    ([cm values], [px values]) per rig. The distance (cm) of every image is the number in its filename.
+    A rig with less than two distances keeps its known samples (see `PX_CM_SAMPLES`).
     """
-    # Extract the coordinates of the points where there is actual values (not NaN) in the xyz cloud of points
-    points_rows, points_cols = np.where(~np.isnan(depth[:, :, 0]))
+    samples = {"mono": [[], []], "stereo": [[], []]}
+    with open(path) as file:
+        for line in file:
+            name, _, value = line.partition(" : ")
+            distance = re.search(r"(mono|stereo)-(\d+)", name)
+            if distance is None:
+                continue
+            
+            samples[distance.group(1)][0].append(float(distance.group(2)))
+            samples[distance.group(1)][1].append(float(value))
     
-    # Grab the corresponding points in the xyz cloud of points in an array
-    points_depth = depth[points_rows, points_cols, :] # n*3 array of 3D points (after nan filtering)
+    return {rig: rig_samples if len(set(rig_samples[0])) > 1 else PX_CM_SAMPLES[rig]
+            for rig, rig_samples in samples.items()}
+
+
+class DepthLUT:
+    def __init__(self, table, step):
+        """
+        Lookup table converting a disparity map straight to depth (cm)
+        
+        Params:
+            table (np.ndarray): depth (cm) of every quantized disparity
+            step (float): the disparity between two entries of the table
+        """
+        self.table = table
+        self.step = step
+        
+        
+    @classmethod
+    def build(cls, camera, stereo, samples = None, step = 2 ** -14, max_disparity = 2):
+        """
+        Build the table of a rig: return_depth followed by px_cm_ratio for every quantized disparity
+        
+        Params:
+            camera (CameraModel): the camera's parameters (see utils/camera.py)
+            stereo (bool): True for the stereo rig, False for the mono rig
+            samples (list): ([cm values], [px values]) to fit, the known samples of the rig if None
+            step (float): the disparity between two entries of the table
+            max_disparity (float): larger disparities are clipped to that value
+        """
+        m, c = fit_px_cm(samples, False) if samples is not None else px_cm_model(stereo, False)
+        disparity = np.arange(0, max_disparity + step, step)
+        
+        return cls(m * return_depth(disparity, stereo, camera = camera) + c, step)
     
-    # Grab the corresponding points in the image in an array
-    points_image =  image[points_rows, points_cols, 0:3] # n*3 array of RGB points (after nan filtering)
     
-    # Create a dict of data
-    data = {'x': points_depth[:, 0], 'y': points_depth[:, 1], 'z': points_depth[:, 2], 
-            'red': points_image[:, 2], 'green': points_image[:, 1], 'blue': points_image[:, 0]}
-            
-    # build a cloud
-    cloud = PyntCloud(pd.DataFrame(data))
+    def __call__(self, disparity):
+        """
+        Return the depth (cm) of a disparity map, a zero disparity has the depth of the table's first entry
+        """
+        index = np.divide(disparity, self.step)
+        np.rint(index, out = index)
+        np.clip(index, 0, len(self.table) - 1, out = index)
+        index = index.astype(np.int32)
+        
+        return self.table[index]
+
+
+# Lookup tables already loaded by this process, keyed by their file, the calibration and the given samples
+_LUTS = {}
+
+def load_depth_luts(camera, path = "", samples = None):
+    """
+    Return the lookup tables of both rigs {"stereo": DepthLUT, "mono": DepthLUT},
+    loaded from the file saved alongside the calibration or built again if the calibration or the samples have changed.
+    The samples ({rig: ([cm values], [px values])}) default to the ones measured by utils/finetuning.py
+    if it has been run, to the known samples of the rigs otherwise.
+    """
+    filename = path + 'outputs/depth_lut.npz'
+    loaded = (filename, camera.digest, str(samples) if samples is not None else None)
+    if loaded in _LUTS:
+        return _LUTS[loaded]
+    
+    # The saved tables are keyed by the calibration and the samples they are fitted from
+    if samples is None and os.path.exists(path + 'outputs/finetuning.txt'):
+        samples = read_finetuning(path + 'outputs/finetuning.txt')
+    key = camera.digest + (str(samples) if samples is not None else "")
+    
+    # Load the saved tables, built again if the file cannot be read
+    luts = None
+    if os.path.exists(filename):
+        try:
+            with np.load(filename) as data:
+                if str(data["key"]) == key:
+                    step = float(data["step"])
+                    luts = {"stereo": DepthLUT(data["stereo"], step), "mono": DepthLUT(data["mono"], step)}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            luts = None
+    
+    # Build and save the tables, atomically so that other processes never read a partial file
+    if luts is None:
+        luts = {rig: DepthLUT.build(camera, rig == "stereo", samples[rig] if samples is not None else None)
+                for rig in ("stereo", "mono")}
+        temporary = "%s.%d.tmp" % (filename, os.getpid())
+        with open(temporary, "wb") as file:
+            np.savez(file, key = key, step = luts["stereo"].step, stereo = luts["stereo"].table, mono = luts["mono"].table)
+        os.replace(temporary, filename)
+    
+    _LUTS[loaded] = luts
+    
+    return luts
+
+
+@METRICS.timed()
+def point_cloud(image, depth, out = None):
+    """
+    Build the XYZRGB point cloud as a single structured array, into `out` (of PLY_DTYPE) if it is given.
+    `depth` is either a depth map, whose points are placed at their (row, col) position,
+    or an array of xyz points with the same height and width as the image.
+    """
+    height, width = depth.shape[:2]
+    points = np.empty((height, width), dtype = PLY_DTYPE) if out is None else out
+    
+    # Fill the coordinates
+    if depth.ndim == 2:
+        points['x'] = np.arange(height)[:, np.newaxis]
+        points['y'] = np.arange(width)[np.newaxis, :]
+        points['z'] = depth
+    else:
+        points['x'], points['y'], points['z'] = depth[:, :, 0], depth[:, :, 1], depth[:, :, 2]
+    
+    # Fill the colors (the image is BGR)
+    points['red'], points['green'], points['blue'] = image[:, :, 2], image[:, :, 1], image[:, :, 0]
+    points = points.reshape(-1)
+    
+    # Remove the points without actual values (NaN)
+    nan = np.isnan(points['z'])
+    return points[~nan] if nan.any() else points
+
 
+@METRICS.timed()
+def write_ply(points, path):
+    """
+    Write a point cloud to a binary little-endian .ply file
+    """
+    # Write the header
+    header = ["ply", "format binary_little_endian 1.0", "element vertex %d" % len(points)]
+    for name in points.dtype.names:
+        header.append("property %s %s" % (PLY_TYPES[points.dtype[name].str[1:]], name))
+    header.append("end_header\n")
+    
+    with open(path, 'wb') as file:
+        file.write("\n".join(header).encode('ascii'))
+        
+        # Write the points straight from the buffer
+        np.ascontiguousarray(points, dtype = PLY_DTYPE).tofile(file)
+    
+    
+def depth_to_ply(image, depth, name = "my_pts", folder = "outputs/", out = None):
+    """
+    Convert depth map to point cloud (see `point_cloud`)
+    """
+    # Build the cloud of points
+    points = point_cloud(image, depth, out)
+    
     # Write .ply file
-    cloud.to_file('outputs/' + name + '.ply')
+    write_ply(points, folder + name + '.ply')
     
-    return cloud, data
+    # Create a dict of data
+    data = {key: points[key] for key in PLY_DTYPE.names}
+    
+    return points, data
 
 
-def display_individual_depth(dispar_map, dispar_range, stereo, debug = False):
+def display_individual_depth(dispar_map, dispar_range, stereo, debug = False, camera = None, lut = None):
     """
-    Return the depth of the object at that returned location with a pre-specified depth range
+    Return the depth of the object at that returned location with a pre-specified depth range.
+    If a `lut` (see DepthLUT) is given, the depth is only looked up inside the object.
+    Return None if there is no object in that range.
     """
     # Remove out-of-bound area
     mask = cv.inRange(dispar_map, dispar_range[0], dispar_range[1])
     dispar_safe = cv.bitwise_and(dispar_map, dispar_map, mask = mask)
     
-    # Calculate depth map
-    depth_map = return_depth(dispar_safe, stereo, "../") if debug else px_cm_ratio(return_depth(dispar_safe, stereo), stereo, False)
-    
     # Contour detection 
     contours, _ = cv.findContours(mask, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+    if len(contours) == 0:
+        return None
     cnts = sorted(contours, key = cv.contourArea, reverse = True)
 
     # Check if detected contour is significantly large (to avoid multiple tiny regions)
@@ -104,6 +287,79 @@ def display_individual_depth(dispar_map, dispar_range, stereo, debug = False):
     cv.drawContours(new_mask, cnts, 0, (255), -1)
 
     # Calculating the average depth of the object closer than the safe distance
-    depth_mean, _ = cv.meanStdDev(depth_map, mask = new_mask)
+    if lut is not None and not debug:
+        depth_mean = np.full((1, 1), lut(dispar_safe[new_mask > 0]).mean())
+    else:
+        depth_map = return_depth(dispar_safe, stereo, "../", camera) if debug else px_cm_ratio(return_depth(dispar_safe, stereo, camera = camera), stereo, False)
+        depth_mean, _ = cv.meanStdDev(depth_map, mask = new_mask)
     
     return x, y, x + w, y + h, depth_mean
+
+
+@METRICS.timed()
+def detect_objects(dispar_map, value_ranges, to_depth):
+    """
+    Find the largest object of every range and its depth statistics, as `display_individual_depth` does.
+    The disparity map is quantized once into the ID of its range, which gives the bounding box of every range,
+    and only the box of every range is searched for contours.
+    The ranges must be sorted and may only share their edges, a disparity on a shared edge belongs to both ranges.
+    The object is the largest outer contour filled, its holes count as a zero disparity.
+    `to_depth` converts disparities to depth, e.g. a DepthLUT.
+    Return an array of DETECTION_DTYPE with one detection per range that contains an object.
+    """
+    detections, values = [], []
+    value_ranges = np.asarray(value_ranges, dtype = np.float64).reshape(-1, 2)
+    if len(value_ranges) > 63:
+        raise ValueError("At most 63 ranges can be detected at once, got %d" % len(value_ranges))
+    
+    # ID (from 1) of the range of every pixel: # of ranges starting at or below the disparity
+    # minus # of ranges ending below it is 1 inside a range, and 2 on the edge shared by a range and the previous one
+    starts = np.searchsorted(value_ranges[:, 0], dispar_map, side = 'right').astype(np.uint8)
+    ends = np.searchsorted(value_ranges[:, 1], dispar_map, side = 'left').astype(np.uint8)
+    count = starts - ends
+    ids = np.where(count > 0, starts, np.uint8(0))
+    shared = count == 2
+    
+    # Ranges present in every row and column, as bits (bit 0 is out of every range)
+    dtype = np.uint16 if len(value_ranges) < 16 else np.uint64
+    bits = np.left_shift(dtype(1), ids, dtype = dtype)
+    bits |= np.left_shift(shared.astype(dtype), ids, dtype = dtype) >> dtype(1)
+    rows, cols = np.bitwise_or.reduce(bits, axis = 1), np.bitwise_or.reduce(bits, axis = 0)
+    
+    for k, dispar_range in enumerate(value_ranges, 1):
+        # Only look at the bounding box of the range's pixels
+        bit = dtype(1) << dtype(k)
+        present_rows, present_cols = np.flatnonzero(rows & bit), np.flatnonzero(cols & bit)
+        if len(present_rows) == 0:
+            continue
+        y, x = present_rows[0], present_cols[0]
+        roi = np.s_[y:present_rows[-1] + 1, x:present_cols[-1] + 1]
+        mask = (ids[roi] == k) | ((ids[roi] == k + 1) & shared[roi])
+        
+        # Largest outer contour of the range, filled
+        contours, _ = cv.findContours(mask.view(np.uint8), cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+        largest = max(contours, key = cv.contourArea)
+        left, top, width, height = cv.boundingRect(largest)
+        filled = np.zeros(mask.shape, np.uint8)
+        cv.drawContours(filled, [largest], 0, 255, -1)
+        
+        # Disparity inside the object, zero where it is out of the range
+        inside = filled > 0
+        values.append(np.where(mask[inside], dispar_map[roi][inside], 0))
+        detections.append((x + left, y + top, x + left + width, y + top + height, len(values[-1]), 0, 0,
+                           dispar_range[0], dispar_range[1]))
+        
+    detections = np.array(detections, dtype = DETECTION_DTYPE)
+    if len(detections) == 0:
+        return detections
+    
+    # Depth statistics of every detection at once
+    label = np.repeat(np.arange(len(values)), [len(value) for value in values])
+    depth = to_depth(np.concatenate(values))
+    count = np.bincount(label, minlength = len(detections))
+    mean = np.bincount(label, weights = depth, minlength = len(detections)) / count
+    depth_sq = np.square(depth, out = depth)
+    mean_sq = np.bincount(label, weights = depth_sq, minlength = len(detections)) / count
+    detections['depth'], detections['depth_std'] = mean, np.sqrt(np.maximum(mean_sq - mean ** 2, 0))
+    
+    return detections
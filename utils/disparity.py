@@ -1,31 +1,125 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2 as cv
+import yaml
 
-def scale(value, min_dispar, num_dispar):
+try:
+    from utils.metrics import METRICS
+except ImportError:
+    # Imported from the utils folder, e.g. by finetuning.py
+    from metrics import METRICS
+
+# Parameters of the 720p, 360p and 180p levels
+LEVELS = {
+    "high": {"dimension": (1280, 720), "kernel": 3, "block": 20, "min_disparity": 5, "disparity": 8},
+    "mid": {"dimension": (640, 360), "kernel": 5, "block": 18, "min_disparity": 0, "disparity": 8},
+    "low": {"dimension": (320, 180), "kernel": 7, "block": 15, "min_disparity": 0, "disparity": 5},
+}
+
+def load_levels(path = 'outputs/disparity.yaml'):
     """
-    Scale the disparity from pixels to pixel/pixel
+    Read the parameters of every level from a config file (e.g. written by utils/sweep.py),
+    the missing parameters keep their default value
     """
-    return (value / (16 ** 2) - min_dispar) / num_dispar  #cm/cm
+    with open(path) as file:
+        config = yaml.safe_load(file) or {}
+    
+    levels = {}
+    for name, params in LEVELS.items():
+        levels[name] = {**params, **config.get(name, {})}
+        levels[name]["dimension"] = tuple(levels[name]["dimension"])
+        
+    return levels
 
 
-def disparity_helper(imgL, imgR, params):
+# SGBM matchers and blur buffers of the current thread, and the registry's statistics
+_local = threading.local()
+_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+# Thread pool shared by the parallel mode
+_pool, _pool_workers = None, None
+_pool_lock = threading.Lock()
+
+def scale(value, min_dispar, num_dispar, out = None, dtype = np.float64):
     """
-    Return the disparity accordingly to the input images and parameters
+    Scale the disparity from pixels to pixel/pixel, as `dtype` or into `out` if it is given
+    """
+    # Work in a single buffer
+    scaled = np.divide(value, 16 ** 2, out = out, dtype = out.dtype if out is not None else dtype)
+    scaled -= min_dispar
+    scaled /= num_dispar
+    
+    return scaled  #cm/cm
+
+
+def get_matcher(params):
+    """
+    Return the SGBM matcher of the input parameters, created once per thread and reused afterwards
     """
-    # Get parameters
     kernel, min_dispar, dispar, block = params["kernel"], params["min_disparity"], params["disparity"], params["block"]
+    key = (kernel, block, min_dispar, dispar)
+    
+    # Look up the registry of the current thread
+    if not hasattr(_local, "matchers"):
+        _local.matchers = {}
+    matcher = _local.matchers.get(key)
+    
+    with _stats_lock:
+        _stats["hits" if matcher is not None else "misses"] += 1
+    
+    # Create the matcher on the first use
+    if matcher is None:
+        matcher = cv.StereoSGBM_create(
+            minDisparity = 16 * min_dispar,
+            numDisparities = 16 * dispar,
+            blockSize = block,
+            speckleRange = 2,
+            P1 = 8 * 3 * kernel ** 2, P2 = 32 * 3 * kernel ** 2)
+        _local.matchers[key] = matcher
+        
+    return matcher
+
+
+def matcher_stats():
+    """
+    Return the # of hits and misses of the matcher registry (a miss creates a new matcher)
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def blur(img, kernel, slot):
+    """
+    Blur an image to remove noises, into a buffer of the current thread that is reused across frames.
+    `slot` tells apart images of the same size that must be alive at the same time.
+    """
+    if not hasattr(_local, "buffers"):
+        _local.buffers = {}
+    key = (slot, img.shape, img.dtype.str)
+    buffer = _local.buffers.get(key)
+    
+    # Reuse the buffer of the previous frame
+    buffer = cv.GaussianBlur(img, (kernel, kernel), 0, dst = buffer)
+    _local.buffers[key] = buffer
     
+    return buffer
+
+
+@METRICS.timed()
+def disparity_helper(imgL, imgR, params):
+    """
+    Return the disparity accordingly to the input images and parameters
+    """
     # Blur images to remove noises
-    blur_imgL = cv.GaussianBlur(imgL, (kernel, kernel), 0)
-    blur_imgR = cv.GaussianBlur(imgR, (kernel, kernel), 0)
+    blur_imgL = blur(imgL, params["kernel"], "left")
+    blur_imgR = blur(imgR, params["kernel"], "right")
     
     # Calculate disparity
-    stereo = cv.StereoSGBM_create(
-        minDisparity = 16 * min_dispar,
-        numDisparities = 16 * dispar,
-        blockSize = block,
-        speckleRange = 2,
-        P1 = 8 * 3 * kernel ** 2, P2 = 32 * 3 * kernel ** 2)
+    stereo = get_matcher(params)
 
     # Return disparity
     return stereo.compute(blur_imgL, blur_imgR)
@@ -35,9 +129,6 @@ def calculate_disparity_dim(imgL, imgR, params):
     """
     Calculate the disparity given a specific dimension and parameters
     """
-    # Deep copy
-    imgL, imgR = imgL.copy(), imgR.copy()
-    
     # Resize
     dim = params["dimension"]
     resized_imgL, resized_imgR = cv.resize(imgL, dim), cv.resize(imgR, dim) # Resize
@@ -46,26 +137,63 @@ def calculate_disparity_dim(imgL, imgR, params):
     return disparity_helper(resized_imgL, resized_imgR, params)
 
 
-def combine_disparity(dim, low, mid, high, value_ranges):
+def range_mask(dispar_map, value_ranges):
     """
-    Combine the disparity of different resolutions
+    Return the mask of the pixels whose disparity falls inside any of the ranges
     """
-    combined = low.copy()
-    
+    mask = np.zeros(dispar_map.shape, dtype = bool)
     for value_range in value_ranges:
-        for i in range(dim[1]):
-            for j in range(dim[0]): 
-                low_value, mid_value, high_value = low[i][j], mid[i][j], high[i][j]
-                if low_value > value_range[0] and low_value < value_range[1]:
-                    combined[i][j] = (5 * low_value + 3 * mid_value + 2 * high_value) / 10
+        mask |= (dispar_map > value_range[0]) & (dispar_map < value_range[1])
+        
+    return mask
+
+
+def blend(low_value, mid_value, high_value, weights = (5, 3, 2)):
+    """
+    Return the weighted average of the disparity of different resolutions
+    """
+    w_low, w_mid, w_high = weights
+    
+    return (w_low * low_value + w_mid * mid_value + w_high * high_value) / (w_low + w_mid + w_high)
+
+
+def combine_disparity(dim, low, mid, high, value_ranges, weights = (5, 3, 2), out = None):
+    """
+    Combine the disparity of different resolutions.
+    `weights` are the blending weights of the (low, mid, high) levels. If `out` is given,
+    the result is written in place into that preallocated buffer.
+    """
+    # Start from the low-resolution disparity
+    if out is None:
+        combined = low.copy()
+    else:
+        combined = out
+        np.copyto(combined, low)
+    
+    # Cast for empty input
+    if len(value_ranges) == 0:
+        return combined
+    
+    # Build one mask covering every range
+    region = np.s_[:dim[1], :dim[0]]
+    low_region = low[region]
+    mask = range_mask(low_region, value_ranges)
+    
+    # Blend the different resolutions inside the mask
+    combined[region][mask] = blend(low_region[mask], mid[region][mask], high[region][mask], weights)
     
     return combined
 
 
-def return_ranges(dispar_map, min_dispar, max_dispar, bins, threshold):
+def return_ranges(dispar_map, min_dispar, max_dispar, bins, threshold, dim = None):
     """
-    Return all ranges with intensity larger then the specified threshold
+    Return all ranges with intensity larger then the specified threshold.
+    If `dim` is given, the threshold is a # of pixels at that dimension and is rescaled to the map's size.
     """
+    # Rescale the threshold to the map's size
+    if dim is not None:
+        threshold = threshold * dispar_map.size / (dim[0] * dim[1])
+    
     # Remove the out-of-range regions and make a historgram
     mask = cv.inRange(dispar_map, min_dispar, max_dispar)
     dispar_safe = cv.bitwise_and(dispar_map, dispar_map, mask = mask)
@@ -86,31 +214,831 @@ def return_ranges(dispar_map, min_dispar, max_dispar, bins, threshold):
     return dispar_range
 
 
-def return_disparity(imgL, imgR):
+class DisparityHistogram:
+    def __init__(self, dispar_map, low = 0.0, high = 2.0, step = 0.001, dim = None):
+        """
+        Fine-grained histogram of a disparity map, built once to answer several `return_ranges` queries
+        
+        Params:
+            dispar_map (np.ndarray): the (native resolution) disparity map
+            low, high (float): range of the histogram
+            step (float): width of a fine bin, the edges of every query's bins are rounded to a multiple of it
+            dim ((int, int)): if given, thresholds are # of pixels at that dimension and are rescaled to the map's size
+        """
+        self.low, self.step = low, step
+        self.scale = dispar_map.size / (dim[0] * dim[1]) if dim is not None else 1
+        self.dispar_map = dispar_map
+        
+        # Count every fine bin in a single pass
+        n_bins = int(round((high - low) / step))
+        self.counts = cv.calcHist([dispar_map.astype(np.float32)], [0], None, [n_bins], [low, high]).ravel()
+        
+        
+    def index(self, value):
+        """
+        Return the fine bin starting at the input value
+        """
+        index = (value - self.low) / self.step
+        if not np.isclose(index, round(index)):
+            raise ValueError("%s is not aligned with the histogram's bins" % value)
+        
+        return int(round(index))
+        
+        
+    def ranges(self, min_dispar, max_dispar, bins, threshold, merge = False):
+        """
+        Return all ranges with intensity larger then the specified threshold (see `return_ranges`).
+        If `merge` is True, adjacent ranges are merged together.
+        """
+        # Sum the fine bins of every requested bin, the last one includes its upper edge
+        start, stop = self.index(min_dispar), self.index(max_dispar)
+        if bins > stop - start:
+            raise ValueError("%d bins between %s and %s are narrower than the histogram's bins (%s)"
+                             % (bins, min_dispar, max_dispar, self.step))
+        edges = np.linspace(start, stop, bins + 1).round().astype(int)
+        counts = np.add.reduceat(self.counts[start:stop], edges[:-1] - start)
+        counts[-1] += np.count_nonzero(self.dispar_map == max_dispar)
+        
+        # Return all ranges that has intensity larger then the threshold, as [start, end, index of the last bin]
+        bin_size = (max_dispar - min_dispar) / bins
+        dispar_range = []
+        for i in np.flatnonzero(counts > threshold * self.scale):
+            if merge and dispar_range and dispar_range[-1][2] == i - 1:
+                dispar_range[-1][1:] = [bin_size * (i + 1), i]
+            else:
+                dispar_range.append([bin_size * i, bin_size * (i + 1), i])
+        
+        # Add min value to that range
+        return np.array([value[:2] for value in dispar_range]).reshape(-1, 2) + min_dispar
+
+
+def get_pool(workers = None):
     """
-    Calculate the disparity of the input images
+    Return the thread pool shared by the parallel mode, recreated if the # of workers changes
     """
-    # Original dimension
-    dim = imgL.shape[::-1]
+    global _pool, _pool_workers
+    
+    with _pool_lock:
+        if _pool is None or workers != _pool_workers:
+            if _pool is not None:
+                _pool.shutdown(wait = False)
+            _pool, _pool_workers = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "disparity"), workers
+            
+        return _pool
+
+
+def timed(timings, name, stage, func, *args):
+    """
+    Call `func` and record its running time (s) as timings[name][stage]
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    if timings is not None:
+        timings.setdefault(name, {})[stage] = time.perf_counter() - start
+        
+    return result
+
+
+@METRICS.timed()
+def build_pyramid(img, dims):
+    """
+    Return the input image at every dimension (largest first), without copy.
+    Every level is resized from the input with bilinear interpolation, the parameters of the levels
+    and the px->cm samples have been tuned on such images.
+    """
+    return [img if (img.shape[1], img.shape[0]) == dim else cv.resize(img, dim) for dim in dims]
+
+
+@METRICS.timed()
+def blur_new(img, params):
+    """
+    Blur an image into a new buffer
+    """
+    kernel = params["kernel"]
+    
+    return cv.GaussianBlur(img, (kernel, kernel), 0)
+
+
+@METRICS.timed()
+def match(blur_imgL, blur_imgR, params):
+    """
+    Calculate the disparity of blurred images
+    """
+    return get_matcher(params).compute(blur_imgL, blur_imgR)
+
+
+class DisparityPyramid:
+    def __init__(self, disparities, dim, dtype = np.float64, arena = None, levels = None, regions = None):
+        """
+        Disparities of every level at their native resolution, upsampled to the original dimension on demand
+        
+        Params:
+            disparities (dict): the raw SGBM output of every level
+            dim ((int, int)): the original dimension (width, height)
+            dtype (type): float type of the scaled disparities
+            arena (BufferArena): if given, the work buffers and the results are taken from it (see utils/helpers.py),
+                so they are only valid until the next frame computed with the same arena
+            levels (dict): the parameters of every level (see `LEVELS`)
+            regions (dict): boxes (x_left, y_top, x_right, y_bot) at the original dimension where the disparity
+                of a level has been computed, the levels left out are valid everywhere (see `RoiDisparity`)
+        """
+        self.disparities = disparities
+        self.levels = levels if levels is not None else LEVELS
+        self.regions = regions if regions is not None else {}
+        self.dim = dim
+        self.dtype = dtype
+        self.arena = arena
+        self.scaled, self.upsampled = {}, {}
+        
+        
+    def buffer(self, name, shape, dtype = None):
+        """
+        Return a work buffer of the arena, or None to let the caller allocate it
+        """
+        if self.arena is None:
+            return None
+        
+        return self.arena.get(name, shape, dtype if dtype is not None else self.dtype)
+    
+    
+    def resized(self, name):
+        """
+        Return the raw disparity of a level resized to the original dimension
+        """
+        shape = (self.dim[1], self.dim[0])
+        
+        return cv.resize(self.disparities[name], self.dim, dst = self.buffer("resized", shape, np.int16))
+    
+    
+    def native(self, name):
+        """
+        Return the scaled disparity of a level at its native resolution
+        """
+        if name not in self.scaled:
+            params, raw = self.levels[name], self.disparities[name]
+            self.scaled[name] = scale(raw, params["min_disparity"], params["disparity"],
+                                      self.buffer("native_" + name, raw.shape), self.dtype)
+            
+        return self.scaled[name]
+    
+    
+    def upsample(self, name, out = None):
+        """
+        Return the scaled disparity of a level upsampled to the original dimension, in a new buffer or `out`
+        """
+        params = self.levels[name]
+        
+        return scale(self.resized(name), params["min_disparity"], params["disparity"], out, self.dtype)
+    
+    
+    def full(self, name):
+        """
+        Return the scaled disparity of a level at the original dimension
+        """
+        if name not in self.upsampled:
+            self.upsampled[name] = self.upsample(name, self.buffer("full_" + name, (self.dim[1], self.dim[0])))
+            
+        return self.upsampled[name]
+    
+    
+    def masked(self, name, mask):
+        """
+        Return the scaled disparity of a level at the original dimension, only inside the mask
+        """
+        if name in self.upsampled:
+            return self.upsampled[name][mask]
+        
+        # Upsample the raw disparity and only scale the masked pixels
+        params = self.levels[name]
+        
+        return scale(self.resized(name)[mask], params["min_disparity"], params["disparity"], dtype = self.dtype)
+    
+    
+    def valid(self, name):
+        """
+        Return the mask of the pixels (at the original dimension) where a level has been computed,
+        or None if it has been computed everywhere
+        """
+        if name not in self.regions:
+            return None
+        
+        mask = np.zeros((self.dim[1], self.dim[0]), bool)
+        for x_left, y_top, x_right, y_bot in self.regions[name]:
+            mask[y_top:y_bot, x_left:x_right] = True
+            
+        return mask
+    
+    
+    def partial_blend(self, low_value, mask, names, weights = (5, 3, 2)):
+        """
+        Return the weighted average of the low level and of the other levels where they have been computed
+        """
+        w_low = weights[0]
+        value, total = w_low * low_value, np.full(low_value.shape, w_low, low_value.dtype)
+        for name in names:
+            weight, valid = weights[1 if name == "mid" else 2], self.valid(name)
+            valid = valid[mask] if valid is not None else slice(None)
+            value[valid] += weight * self.masked(name, mask)[valid]
+            total[valid] += weight
+            
+        return value / total
+    
+    
+    @METRICS.timed()
+    def combine(self, value_ranges, weights = (5, 3, 2), out = None):
+        """
+        Combine the disparity of different resolutions (see `combine_disparity`).
+        The mid and high levels are never upsampled to full float maps, and are left out of the blend
+        where they have not been computed (see `DeadlineScheduler` and `RoiDisparity`).
+        """
+        out = out if out is not None else self.buffer("combined", (self.dim[1], self.dim[0]))
+        
+        # Start from the low-resolution disparity, copied only if it is used elsewhere
+        if "low" not in self.upsampled:
+            combined = self.upsample("low", out)
+        elif out is not None:
+            combined = out
+            np.copyto(combined, self.upsampled["low"])
+        else:
+            combined = self.upsampled["low"].copy()
+            
+        # Cast for empty input or the low level alone
+        present = [name for name in ("mid", "high") if name in self.disparities]
+        if len(value_ranges) == 0 or not present:
+            return combined
+        
+        # Blend the different resolutions inside the ranges
+        mask = range_mask(combined, value_ranges)
+        if len(present) == 2 and not self.regions:
+            combined[mask] = blend(combined[mask], self.masked("mid", mask), self.masked("high", mask), weights)
+        else:
+            combined[mask] = self.partial_blend(combined[mask], mask, present, weights)
+        
+        return combined
+    
+    
+def scaled_params(params, dim, exact = False):
+    """
+    Return the parameters of a level matched at another dimension, its search range scaled to the width.
+    The matcher needs a whole search range, widened to cover the scaled one, but its disparities must be
+    scaled back with the `exact` range to keep the same meaning as the level's (the pixels out of it,
+    e.g. not matched, are then out of [0, 1] as with the level's own matcher).
+    """
+    ratio = dim[0] / params["dimension"][0]
+    if exact:
+        return {**params, "dimension": dim, "min_disparity": params["min_disparity"] * ratio,
+                "disparity": params["disparity"] * ratio}
     
-    # 720p
-    hi_params = {"dimension": (1280, 720), "kernel": 3, "block": 20,
-              "min_disparity": 5, "disparity": 8}
-    hi_disparity = calculate_disparity_dim(imgL, imgR, hi_params)
+    # Round the range outwards (the ratio's floating-point error is ignored)
+    low = int(np.floor(round(params["min_disparity"] * ratio, 6)))
+    high = int(np.ceil(round((params["min_disparity"] + params["disparity"]) * ratio, 6)))
     
-    # 360p
-    mid_params = {"dimension": (640, 360), "kernel": 5, "block": 18,
-              "min_disparity": 0, "disparity": 8}
-    mid_disparity = calculate_disparity_dim(imgL, imgR, mid_params)
+    return {**params, "dimension": dim, "min_disparity": low, "disparity": max(high - low, 1)}
+
+
+def parallel_disparity(imgL, imgR, workers = None, timings = None, levels = None):
+    """
+    Calculate the disparity of every level on the shared thread pool
+    """
+    levels = levels if levels is not None else LEVELS
+    pool = get_pool(workers)
+    dims = [params["dimension"] for params in levels.values()]
+    
+    # Build the left and right pyramids
+    pyramidL = pool.submit(timed, timings, "pyramid", "left", build_pyramid, imgL, dims)
+    pyramidR = pool.submit(timed, timings, "pyramid", "right", build_pyramid, imgR, dims)
+    levelsL, levelsR = pyramidL.result(), pyramidR.result()
+    
+    # Blur the left and right images of every level
+    blurred = {name: (pool.submit(timed, timings, name, "blur_left", blur_new, levelL, params),
+                      pool.submit(timed, timings, name, "blur_right", blur_new, levelR, params))
+               for (name, params), levelL, levelR in zip(levels.items(), levelsL, levelsR)}
+    
+    # Match every level as soon as both of its images are ready
+    disparities = {}
+    for name, params in levels.items():
+        futureL, futureR = blurred[name]
+        disparities[name] = pool.submit(timed, timings, name, "sgbm", match, futureL.result(), futureR.result(), params)
+        
+    return {name: future.result() for name, future in disparities.items()}
+
+
+def compute_pyramid(imgL, imgR, parallel = False, workers = None, timings = None, dtype = np.float64, arena = None,
+                    levels = None, band_budget = None):
+    """
+    Calculate the disparity of every level of the input images.
+    If `parallel` is True, the levels are computed concurrently on a pool of `workers` threads.
+    If `timings` is a dict, the running time (s) of every level's stages is recorded into it.
+    `levels` replaces the default parameters of the levels (see `load_levels`).
+    If `band_budget` (bytes) is given and the images are larger than the high level, the high level is matched
+    at the images' resolution by bands within that memory budget (see `banded_disparity`).
+    `dtype` and `arena` are passed to the returned `DisparityPyramid`.
+    """
+    levels = levels if levels is not None else LEVELS
+    dim = imgL.shape[::-1]
+    banded = (band_budget is not None and "high" in levels
+              and dim[0] * dim[1] > levels["high"]["dimension"][0] * levels["high"]["dimension"][1])
+    pyramid_levels = {name: params for name, params in levels.items() if not (banded and name == "high")}
     
-    # 180p
-    low_params = {"dimension": (320, 180), "kernel": 7, "block": 15,
-              "min_disparity": 0, "disparity": 5}
-    low_disparity = calculate_disparity_dim(imgL, imgR, low_params)
+    if parallel:
+        disparities = parallel_disparity(imgL, imgR, workers, timings, pyramid_levels)
+    else:
+        # Build the left and right pyramids
+        dims = [params["dimension"] for params in pyramid_levels.values()]
+        levelsL = timed(timings, "pyramid", "left", build_pyramid, imgL, dims)
+        levelsR = timed(timings, "pyramid", "right", build_pyramid, imgR, dims)
+        
+        # Calculate the disparity of every level
+        disparities = {name: timed(timings, name, "total", disparity_helper, levelL, levelR, params)
+                       for (name, params), levelL, levelR in zip(pyramid_levels.items(), levelsL, levelsR)}
     
-    # Resize and normalize
-    high = scale(cv.resize(hi_disparity, dim), hi_params["min_disparity"], hi_params["disparity"])
-    mid = scale(cv.resize(mid_disparity, dim), mid_params["min_disparity"], mid_params["disparity"])
-    low = scale(cv.resize(low_disparity, dim), low_params["min_disparity"], low_params["disparity"])
+    # Match the high level at the images' resolution, once the pool is free
+    if banded:
+        matching, exact = scaled_params(levels["high"], dim), scaled_params(levels["high"], dim, exact = True)
+        raw = disparities["high"] = timed(timings, "high", "total", banded_disparity, imgL, imgR, matching,
+                                          band_budget, workers)
+        
+        # The pixels not matched or out of the level's range are given the value of the level's own matcher
+        # for the pixels it does not match, one step below its range
+        ratio = dim[0] / levels["high"]["dimension"][0]
+        out_of_range = ((raw < 256 * exact["min_disparity"])
+                        | (raw >= 256 * (exact["min_disparity"] + exact["disparity"])))
+        raw[out_of_range] = round(256 * exact["min_disparity"] - 16 * ratio)
+        levels = {**levels, "high": exact}
+        
+    return DisparityPyramid(disparities, dim, dtype, arena, levels)
+
+
+def return_disparity(imgL, imgR, parallel = False, workers = None, timings = None, levels = None, band_budget = None):
+    """
+    Calculate the disparity of the input images at the original dimension (see `compute_pyramid`).
+    `levels` is either the parameters of every level or the path of a config file (see `load_levels`).
+    """
+    levels = load_levels(levels) if isinstance(levels, str) else levels
+    pyramid = compute_pyramid(imgL, imgR, parallel, workers, timings, levels = levels, band_budget = band_budget)
+    high, mid, low = (pyramid.full(name) for name in LEVELS)
     
     return high, mid, low
+
+
+def match_overlap(params):
+    """
+    Return the # of pixels a crop needs around a region so that the SGBM path costs of the region
+    settle as in the full image: twice the matching support (the block and the blur)
+    """
+    return params["block"] + params["kernel"]
+
+
+def match_margins(params):
+    """
+    Return the # of pixels (left, other sides) a crop needs around a region so that
+    its disparity is matched with the full search range and the path costs settle (see `match_overlap`)
+    """
+    overlap = match_overlap(params)
+    
+    return 16 * (params["min_disparity"] + params["disparity"]) + overlap, overlap
+
+
+def match_region(imgL, imgR, params, box, out):
+    """
+    Calculate the disparity of a region (x_left, y_top, x_right, y_bot) into the output,
+    matched on a crop covering the search range and the block size
+    """
+    height, width = imgL.shape
+    x0, y0, x1, y1 = box
+    left, other = match_margins(params)
+    
+    cx0, cx1 = max(x0 - left, 0), min(x1 + other, width)
+    cy0, cy1 = max(y0 - other, 0), min(y1 + other, height)
+    crop = match(blur_new(imgL[cy0:cy1, cx0:cx1], params), blur_new(imgR[cy0:cy1, cx0:cx1], params), params)
+    out[y0:y1, x0:x1] = crop[y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0]
+    
+    return out
+
+
+def tile_bounds(length, count):
+    """
+    Return the `count` + 1 boundaries of the tiles splitting a length
+    """
+    return np.linspace(0, length, count + 1).round().astype(int)
+
+
+# Levels run by every quality tier, cheapest first
+TIERS = {"low": ("low",), "mid": ("mid", "low"), "full": ("high", "mid", "low")}
+
+class DeadlineScheduler:
+    def __init__(self, budget, tiers = TIERS, parallel = True, smoothing = 0.3, headroom = 0.8, retry = 60,
+                 workers = None):
+        """
+        Disparity of a stream of frames at the best quality tier that fits a per-frame latency budget.
+        The cost of every level and of the rest of the frame is measured online, and the tier of the next frame
+        is the highest whose predicted latency fits the budget (with some headroom to move up).
+        
+        Params:
+            budget (float): latency budget (s) of a frame
+            tiers (dict): levels run by every tier (see `TIERS`), cheapest first, every tier runs the low level
+            parallel (bool): if True, the levels run concurrently (see `compute_pyramid`)
+            smoothing (float): weight of the latest measure in the running averages of the costs
+            headroom (float): fraction of the budget the predicted latency must fit in to move up a tier
+            retry (int): # of frames after which the next tier is tried again, to measure its levels' cost again
+            workers (int): # of threads of the shared pool
+        """
+        self.budget = budget
+        self.tiers = tiers
+        self.parallel = parallel
+        self.smoothing = smoothing
+        self.headroom = headroom
+        self.retry = retry
+        self.workers = workers
+        
+        # Start at the best tier, so that the cost of every level is measured on the first frame
+        self.tier = list(tiers)[-1]
+        self.costs, self.overheads = {}, {}
+        self.timings, self.latency = {}, None
+        self.counts = {tier: 0 for tier in tiers}
+        self.stay = 0
+        
+        
+    def average(self, average, value):
+        """
+        Return the running average updated with a new measure
+        """
+        return value if average is None else average + self.smoothing * (value - average)
+    
+    
+    def levels(self, tier = None):
+        """
+        Return the parameters of the levels run by a tier, the current one by default
+        """
+        names = self.tiers[tier if tier is not None else self.tier]
+        
+        return {name: params for name, params in LEVELS.items() if name in names}
+    
+    
+    def disparity_cost(self, names):
+        """
+        Return the running time (s) of the levels, or None if one of them has never been measured
+        """
+        costs = [self.costs.get(name) for name in names]
+        if None in costs:
+            return None
+        
+        return max(costs) if self.parallel else sum(costs)
+    
+    
+    def predict(self, tier):
+        """
+        Return the predicted latency (s) of a frame at a tier, or None if it cannot be predicted yet
+        """
+        cost = self.disparity_cost(self.tiers[tier])
+        if cost is None or not self.overheads:
+            return None
+        overhead = self.overheads.get(tier, max(self.overheads.values()))
+        
+        return cost + self.costs.get("pyramid", 0.0) + overhead
+    
+    
+    def compute(self, imgL, imgR, dtype = np.float64, arena = None):
+        """
+        Calculate the disparity of the levels of the current tier (see `compute_pyramid`)
+        """
+        self.timings = {}
+        self.counts[self.tier] += 1
+        
+        return compute_pyramid(imgL, imgR, self.parallel, self.workers, self.timings, dtype, arena, self.levels())
+    
+    
+    def update(self, latency):
+        """
+        Record the latency (s) of the frame computed last and choose the tier of the next frame
+        """
+        # Measured costs of the levels, the rest of the frame is the overhead of the tier
+        names = self.tiers[self.tier]
+        for name in names:
+            self.costs[name] = self.average(self.costs.get(name), sum(self.timings.get(name, {}).values()))
+        pyramid = self.timings.get("pyramid", {})
+        self.costs["pyramid"] = self.average(self.costs.get("pyramid"),
+                                             max(pyramid.values()) if self.parallel else sum(pyramid.values()))
+        overhead = max(latency - self.disparity_cost(names) - self.costs["pyramid"], 0.0)
+        self.overheads[self.tier] = self.average(self.overheads.get(self.tier), overhead)
+        self.latency = self.average(self.latency, latency)
+        
+        # Highest tier that fits the budget, with some headroom above the current one
+        order = list(self.tiers)
+        current = order.index(self.tier)
+        chosen = order[0]
+        for i, tier in enumerate(order):
+            predicted = self.predict(tier)
+            limit = self.budget * (self.headroom if i > current else 1.0)
+            if predicted is not None and predicted <= limit:
+                chosen = tier
+        
+        # The costs of the levels left out are no longer measured, try the next tier again once in a while
+        self.stay = self.stay + 1 if chosen == self.tier else 0
+        if self.stay >= self.retry and chosen != order[-1]:
+            chosen, self.stay = order[order.index(chosen) + 1], 0
+        self.tier = chosen
+        
+        return chosen
+    
+    
+class IncrementalDisparity:
+    def __init__(self, grid = (8, 8), threshold = 8, refresh = 30, levels = ("high", "mid"), workers = None):
+        """
+        Disparity of a stream of frames, only recomputed on the tiles that have changed since the previous frame
+        
+        Params:
+            grid ((int, int)): # of tiles (columns, rows)
+            threshold (float): mean absolute difference (gray level) above which a tile is dirty
+            refresh (int): # of frames between two full computations
+            levels (tuple): levels computed tile by tile, the others are always fully computed
+            workers (int): # of threads of the shared pool
+        """
+        self.grid = grid
+        self.threshold = threshold
+        self.refresh = refresh
+        self.levels = levels
+        self.workers = workers
+        
+        self.frame = 0
+        self.previous = None # Low-resolution left and right frames
+        self.disparities = None
+        self.fraction = 1.0 # Fraction of the tiles recomputed for the last frame
+        
+        
+    def dirty_tiles(self, lowL, lowR, params):
+        """
+        Return the boolean (rows, columns) map of the tiles of a level that have changed since the previous frame
+        """
+        prevL, prevR = self.previous
+        
+        # Mean difference of every tile
+        dirtyL, dirtyR = [(cv.resize(cv.absdiff(low, prev).astype(np.float32), self.grid, interpolation = cv.INTER_AREA)
+                           > self.threshold).astype(np.uint8) for low, prev in ((lowL, prevL), (lowR, prevR))]
+        
+        # A change of the right frame moves the matches of the pixels on its right, up to the level's search range
+        reach = -(-match_margins(params)[0] * self.grid[0] // params["dimension"][0])
+        dirtyR = cv.dilate(dirtyR, np.ones((1, reach + 1), np.uint8), anchor = (reach, 0))
+        
+        # The path costs of a tile also depend on its neighbours on the row
+        return cv.dilate(dirtyL | dirtyR, np.ones((1, 3), np.uint8)).astype(bool)
+    
+    
+    def update(self, levelL, levelR, params, disparity, dirty):
+        """
+        Recompute the disparity of the dirty tiles of a level in place
+        """
+        height, width = levelL.shape
+        xs, ys = tile_bounds(width, self.grid[0]), tile_bounds(height, self.grid[1])
+        
+        for row in range(self.grid[1]):
+            # Merge the consecutive dirty tiles of the row
+            columns = np.flatnonzero(np.diff(np.r_[0, dirty[row].astype(np.int8), 0]))
+            for start, end in columns.reshape(-1, 2):
+                x0, x1, y0, y1 = xs[start], xs[end], ys[row], ys[row + 1]
+                
+                match_region(levelL, levelR, params, (x0, y0, x1, y1), disparity)
+                
+        return disparity
+    
+    
+    def compute(self, imgL, imgR, dtype = np.float64, arena = None):
+        """
+        Calculate the disparity of every level of the next frames (see `compute_pyramid`)
+        """
+        dims = [params["dimension"] for params in LEVELS.values()]
+        levelsL, levelsR = build_pyramid(imgL, dims), build_pyramid(imgR, dims)
+        lowL, lowR = levelsL[-1], levelsR[-1]
+        
+        # Compute every tile on the first frame, on a forced refresh or if the resolution has changed
+        full = (self.disparities is None or self.frame % self.refresh == 0
+                or self.previous[0].shape != lowL.shape)
+        dirty = {name: np.ones(self.grid[::-1], bool) if full else self.dirty_tiles(lowL, lowR, LEVELS[name])
+                 for name in self.levels}
+        
+        pool = get_pool(self.workers)
+        futures = {}
+        for (name, params), levelL, levelR in zip(LEVELS.items(), levelsL, levelsR):
+            if full or name not in self.levels:
+                futures[name] = pool.submit(disparity_helper, levelL, levelR, params)
+            elif dirty[name].any():
+                # Copy the cached disparity, the previous pyramid may still be in use
+                futures[name] = pool.submit(self.update, levelL, levelR, params, self.disparities[name].copy(),
+                                            dirty[name])
+        disparities = {name: futures[name].result() if name in futures else self.disparities[name]
+                       for name in LEVELS}
+        
+        self.fraction = float(np.mean([tiles.mean() for tiles in dirty.values()])) if dirty else 1.0
+        self.previous = (lowL.copy(), lowR.copy())
+        self.disparities = disparities
+        self.frame += 1
+        
+        return DisparityPyramid(disparities, imgL.shape[::-1], dtype, arena)
+
+
+def box_iou(a, b):
+    """
+    Return the intersection over union of two boxes (x_left, y_top, x_right, y_bot)
+    """
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    
+    return intersection / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection)
+
+
+class RoiDisparity:
+    def __init__(self, iou = 0.3, max_age = 5, padding = 32, levels = ("high", "mid"), workers = None):
+        """
+        Disparity of a stream of frames, only computed around the tracked objects at the high and mid levels.
+        The other levels (the 180p one) are computed on the whole frame to discover the new objects.
+        
+        Params:
+            iou (float): minimum intersection over union of a detection and the box of the track it continues
+            max_age (int): # of frames a track is kept without any detection
+            padding (int): # of pixels (at the original dimension) added around the boxes, for the objects' motion
+            levels (tuple): levels only computed around the tracked objects
+            workers (int): # of threads of the shared pool
+        """
+        self.iou = iou
+        self.max_age = max_age
+        self.padding = padding
+        self.levels = levels
+        self.workers = workers
+        
+        # Tracked boxes at the original dimension and their # of frames without detection
+        self.tracks, self.frame = [], 0
+        self.fraction = 1.0
+        
+        
+    def track(self, detections):
+        """
+        Associate the detections (see `utils.depth.detect_objects`) of the latest frame with the tracks,
+        greedily by decreasing intersection over union
+        """
+        boxes = detections[['x_left', 'y_top', 'x_right', 'y_bot']].tolist() if len(detections) else []
+        pairs = sorted(((box_iou(track["box"], box), i, j) for i, track in enumerate(self.tracks)
+                        for j, box in enumerate(boxes)), reverse = True)
+        
+        matched_tracks, matched_boxes = set(), set()
+        for iou, i, j in pairs:
+            if iou < self.iou:
+                break
+            if i in matched_tracks or j in matched_boxes:
+                continue
+            self.tracks[i]["box"], self.tracks[i]["age"] = boxes[j], 0
+            matched_tracks.add(i)
+            matched_boxes.add(j)
+            
+        # Age the tracks left without detection and start a track for every new detection
+        for i, track in enumerate(self.tracks):
+            if i not in matched_tracks:
+                track["age"] += 1
+        self.tracks = [track for track in self.tracks if track["age"] <= self.max_age]
+        self.tracks += [{"box": box, "age": 0} for j, box in enumerate(boxes) if j not in matched_boxes]
+        
+        return [track["box"] for track in self.tracks]
+    
+    
+    def regions(self, dim, level_dim):
+        """
+        Return the padded boxes of the tracks at the original dimension and at a level's dimension
+        """
+        sx, sy = level_dim[0] / dim[0], level_dim[1] / dim[1]
+        boxes, level_boxes = [], []
+        for x_left, y_top, x_right, y_bot in (track["box"] for track in self.tracks):
+            # Pad at the level's dimension, then go back to the original dimension
+            x0 = max(int((x_left - self.padding) * sx), 0)
+            y0 = max(int((y_top - self.padding) * sy), 0)
+            x1 = min(int(np.ceil((x_right + self.padding) * sx)), level_dim[0])
+            y1 = min(int(np.ceil((y_bot + self.padding) * sy)), level_dim[1])
+            level_boxes.append((x0, y0, x1, y1))
+            
+            # Leave out the border pixel, interpolated with the pixels outside once upsampled
+            boxes.append((int(np.ceil((x0 + 1) / sx)), int(np.ceil((y0 + 1) / sy)),
+                          int((x1 - 1) / sx), int((y1 - 1) / sy)))
+            
+        return boxes, level_boxes
+    
+    
+    def match_regions(self, levelL, levelR, params, boxes):
+        """
+        Calculate the disparity of the regions of a level, the rest of the level is left at 0
+        """
+        disparity = np.zeros(levelL.shape, np.int16)
+        for box in boxes:
+            match_region(levelL, levelR, params, box, disparity)
+            
+        return disparity
+    
+    
+    def compute(self, imgL, imgR, dtype = np.float64, arena = None):
+        """
+        Calculate the disparity of every level of the next frames (see `compute_pyramid`),
+        call `track` with the frame's detections afterwards
+        """
+        dim = imgL.shape[::-1]
+        dims = [params["dimension"] for params in LEVELS.values()]
+        levelsL, levelsR = build_pyramid(imgL, dims), build_pyramid(imgR, dims)
+        
+        # Compute the whole first frame, afterwards only around the tracked objects
+        pool = get_pool(self.workers)
+        futures, regions, area = {}, {}, 0
+        for (name, params), levelL, levelR in zip(LEVELS.items(), levelsL, levelsR):
+            if self.frame == 0 or name not in self.levels:
+                futures[name] = pool.submit(disparity_helper, levelL, levelR, params)
+            else:
+                regions[name], boxes = self.regions(dim, params["dimension"])
+                futures[name] = pool.submit(self.match_regions, levelL, levelR, params, boxes)
+                area = max(area, sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in boxes) / levelL.size)
+        disparities = {name: future.result() for name, future in futures.items()}
+        
+        self.fraction = 1.0 if self.frame == 0 else min(area, 1.0)
+        self.frame += 1
+        
+        return DisparityPyramid(disparities, dim, dtype, arena, regions = regions)
+
+
+def band_bytes(width, rows, params):
+    """
+    Estimate the peak memory (bytes) of matching a band of `rows` rows: the blurred images,
+    the SGBM output and internal disparity maps, and the per-row cost buffers of the search range
+    """
+    return width * (8 * rows + 64 * 16 * params["disparity"])
+
+
+def match_band(imgL, imgR, params, y0, y1, overlap, out):
+    """
+    Calculate the disparity of the rows [y0, y1) into the output, matched with `overlap` rows on both sides
+    """
+    cy0, cy1 = max(y0 - overlap, 0), min(y1 + overlap, imgL.shape[0])
+    band = match(blur_new(imgL[cy0:cy1], params), blur_new(imgR[cy0:cy1], params), params)
+    out[y0:y1] = band[y0 - cy0:y1 - cy0]
+
+
+def band_layout(height, width, params, budget, workers = None):
+    """
+    Return the # of bands matched at the same time and their # of rows that fit the budget,
+    the layout with the fewest rows to match per thread (the overlaps included) among up to `workers` bands
+    """
+    overlap = match_overlap(params)
+    best = None
+    for concurrency in range(workers or os.cpu_count() or 1, 0, -1):
+        # Tallest band whose concurrent matches fit in the budget
+        rows = min((budget // concurrency - band_bytes(width, 0, params)) // (8 * width) - 2 * overlap, height)
+        if rows < overlap:
+            continue
+        
+        # Same height for every band, so that the last one is not a sliver
+        count = -(-height // rows)
+        rows = -(-height // count)
+        cost = -(-count // concurrency) * (rows + (2 * overlap if count > 1 else 0))
+        if best is None or cost < best[0]:
+            best = (cost, concurrency, rows)
+            
+    if best is None:
+        raise ValueError("A budget of %d bytes is too small to match bands of width %d, a band needs %d bytes"
+                         % (budget, width, band_bytes(width, 3 * overlap, params)))
+    
+    return best[1], best[2]
+
+
+def banded_disparity(imgL, imgR, params, budget = 256 * 2 ** 20, workers = None, out = None):
+    """
+    Calculate the disparity of images of any resolution by matching horizontal bands on the shared thread pool
+    
+    Params:
+        imgL, imgR (np.ndarray): the rectified grayscale images
+        params (dict): the level's parameters (its dimension is ignored, the images are matched as they are)
+        budget (int): peak memory (bytes) of the bands matched at the same time,
+            the input and output images excluded
+        workers (int): maximum # of bands matched at the same time, the # of cores if None,
+            fewer bands are matched at once if they do not fit the budget
+        out (np.ndarray): int16 output of the images' size, allocated if None
+        
+    Returns:
+        np.ndarray: the raw SGBM output of the images
+    """
+    height, width = imgL.shape
+    overlap = match_overlap(params)
+    concurrency, rows = band_layout(height, width, params, budget, workers)
+    
+    out = np.empty((height, width), np.int16) if out is None else out
+    
+    # A single band is matched on the calling thread
+    if rows >= height:
+        match_band(imgL, imgR, params, 0, height, overlap, out)
+        return out
+    
+    # Match the bands by waves, so that no more than `concurrency` bands are alive at the same time
+    pool = get_pool(workers)
+    starts = range(0, height, rows)
+    for wave in range(0, len(starts), concurrency):
+        futures = [pool.submit(match_band, imgL, imgR, params, y0, min(y0 + rows, height), overlap, out)
+                   for y0 in starts[wave:wave + concurrency]]
+        for future in futures:
+            future.result()
+            
+    return out
@@ -1,54 +1,60 @@
 import cv2 as cv
-import numpy as np
-from matplotlib import pyplot as plt
 import glob
-import re
-from helpers import merge_range
-from disparity import return_disparity, combine_disparity, return_ranges
-from rectify import rectify, undistort
-from depth import display_individual_depth
+from disparity import compute_pyramid, DisparityHistogram
+from rectify import load_rig_profile
+from depth import detect_objects, return_depth
+from camera import load_camera
 
-def main(output, imgL, imgR, name, stereo):
+def main(output, imgL, imgR, name, stereo, camera):
     # Convert to grayscale
     gray_imgL = cv.cvtColor(imgL, cv.COLOR_BGR2GRAY)
     gray_imgR = cv.cvtColor(imgR, cv.COLOR_BGR2GRAY)
     
-    # Rectify
-    retification = rectify(imgL = gray_imgL, imgR = gray_imgR, path = "../")
-    rec_imgL, rec_imgR = undistort(gray_imgL, gray_imgR, retification)
-    gray_imgL, gray_imgR = (rec_imgL, rec_imgR) if not stereo else (gray_imgL, gray_imgR)
+    # Rectify (only the mono rig needs it)
+    if not stereo:
+        rig = load_rig_profile(gray_imgL, gray_imgR, path = "../", camera = camera)
+        gray_imgL, gray_imgR = rig.undistort(gray_imgL, gray_imgR)
 
     # Calculate disparity
-    hi, mid, low = return_disparity(gray_imgL, gray_imgR)
+    pyramid = compute_pyramid(gray_imgL, gray_imgR)
 
-    # Specify the dectected ranges
-    range_low = return_ranges(low, 0.25, 1.25, 10, 50000)
-    range_mid_high = merge_range(return_ranges(low, 0.05, 0.25, 2, 50000))
+    # Specify the dectected ranges (from one histogram of the native 180p disparity)
+    histogram = DisparityHistogram(pyramid.native("low"), dim = pyramid.dim)
+    range_low = histogram.ranges(0.25, 1.25, 10, 50000)
+    range_mid_high = histogram.ranges(0.05, 0.25, 2, 50000, merge = True)
 
     # Combine disparity of different resolution
-    combined = combine_disparity(gray_imgL.shape[::-1], low, mid, hi, range_mid_high)
+    combined = pyramid.combine(range_mid_high)
 
-    # Calculate depth (in pixel)
-    values = []
-    for dispar_range in range_low:
-        _, _, _, _, value = display_individual_depth(combined, dispar_range, stereo, debug = True)
-        values.append(value)
+    # Calculate depth (in pixel) of the objects
+    detections = detect_objects(combined, range_low, lambda dispar: return_depth(dispar, stereo, camera = camera))
+    
+    # The measured object is placed at the center of the image, keep the largest object covering it
+    height, width = combined.shape[:2]
+    centered = detections[(detections['x_left'] <= width // 2) & (detections['x_right'] > width // 2) &
+                          (detections['y_top'] <= height // 2) & (detections['y_bot'] > height // 2)]
+    if len(centered) == 0:
+        print("%s: no object at the center of the image, skipped" % name)
+        return
        
-    # Write output depth values
-    output.write(name + " : " + str(values) + "\n")
+    # Write output depth value
+    output.write(name + " : " + str(float(centered['depth'][centered['area'].argmax()])) + "\n")
             
 if __name__ == "__main__":
     # Create output file to store calib data
     output = open("../outputs/finetuning.txt", "w")
     
+    # Load the camera's parameters once
+    camera = load_camera("../outputs/left.yaml")
+    
     # Specify the inputs
-    images = glob.glob("../assets/finetuning/*left.jpg")
+    images = sorted(glob.glob("../assets/finetuning/*left.jpg"))
     
     # Read all images
     for fname in images:
         imgL = cv.imread(fname)
         imgR = cv.imread(fname.replace("left", "right"))
         stereo = True if "stereo" in fname else False
-        main(output, imgL, imgR, name = (fname.replace(".jpq", "")).replace("../assets/finetuning/", ""), stereo = stereo)
+        main(output, imgL, imgR, name = (fname.replace(".jpq", "")).replace("../assets/finetuning/", ""), stereo = stereo, camera = camera)
     
-    output.close()
\ No newline at end of file
+    output.close()
@@ -1,14 +1,48 @@
 import numpy as np
 import cv2 as cv
 
-def normalize(value: np.ndarray):
+def normalize(value: np.ndarray, out = None):
     """
-    Normalize the input to [0, 1] for visualization
+    Normalize the input to [0, 1] for visualization, into `out` if it is given.
+    Without `out`, a float input keeps its dtype and an integer input is normalized to float64.
     """
     min_value = value.min()
     max_value = value.max()
     
-    return (value - min_value) / (max_value - min_value)
+    # Work in a single buffer, of floats
+    dtype = None if out is not None or np.issubdtype(value.dtype, np.floating) else np.float64
+    normalized = np.subtract(value, min_value, out = out, dtype = dtype)
+    normalized /= max_value - min_value
+    
+    return normalized
+
+
+class BufferArena:
+    def __init__(self):
+        """
+        Work buffers reused across frames, one per (name, shape, dtype).
+        A buffer is overwritten by the next frame, and an arena must only be used by one thread.
+        """
+        self.buffers = {}
+        
+        
+    def get(self, name, shape, dtype = np.float32):
+        """
+        Return the buffer of a name, allocated on its first use
+        """
+        key = (name, tuple(shape), np.dtype(dtype).str)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = np.empty(shape, dtype)
+            
+        return buffer
+    
+    
+    def nbytes(self):
+        """
+        Return the # of bytes held by the arena
+        """
+        return sum(buffer.nbytes for buffer in self.buffers.values())
 
 
 def merge_range(input_range):
@@ -0,0 +1,221 @@
+import csv
+import json
+import time
+import functools
+import threading
+import numpy as np
+import cv2 as cv
+
+class Stage:
+    def __init__(self, metrics, name):
+        """
+        Context manager recording its running time as a sample of a stage
+        """
+        self.metrics = metrics
+        self.name = name
+        self.start = 0.0
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullStage:
+    """
+    Context manager doing nothing, shared by every stage while the metrics are disabled
+    """
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Metrics:
+    def __init__(self, window = 120, enabled = True):
+        """
+        Running times of the pipeline's stages, kept over a rolling window of samples
+
+        Params:
+            window (int): # of latest samples kept for every stage and for the frame rate
+            enabled (bool): if False, the stages and timed functions record nothing and allocate nothing
+        """
+        self.window = window
+        self.enabled = enabled
+        self.lock = threading.Lock()
+
+        # Ring buffers of running times (s), and the # of samples ever recorded
+        self.samples, self.counts = {}, {}
+        self.frames, self.frame_count = np.full(window, np.nan), 0
+
+
+    def record(self, name, elapsed):
+        """
+        Add a running time (s) to a stage
+        """
+        with self.lock:
+            ring = self.samples.get(name)
+            if ring is None:
+                ring = self.samples[name] = np.full(self.window, np.nan)
+            count = self.counts.get(name, 0)
+            ring[count % self.window] = elapsed
+            self.counts[name] = count + 1
+
+
+    def stage(self, name):
+        """
+        Return a context manager timing a stage, e.g. `with metrics.stage("sgbm"): ...`
+        """
+        return Stage(self, name) if self.enabled else NULL_STAGE
+
+
+    def timed(self, name = None):
+        """
+        Decorator timing every call of a function as a stage, named after the function by default
+        """
+        def decorator(func):
+            stage = name or func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+
+            return wrapper
+
+        return decorator
+
+
+    def tick(self):
+        """
+        Mark the end of a frame
+        """
+        if self.enabled:
+            with self.lock:
+                self.frames[self.frame_count % self.window] = time.perf_counter()
+                self.frame_count += 1
+
+
+    def fps(self):
+        """
+        Return the frame rate over the rolling window
+        """
+        with self.lock:
+            frames = self.frames[~np.isnan(self.frames)]
+        if len(frames) < 2:
+            return 0.0
+
+        return (len(frames) - 1) / (frames.max() - frames.min())
+
+
+    def values(self, name):
+        """
+        Return the running times (ms) of a stage in the rolling window
+        """
+        with self.lock:
+            ring = self.samples.get(name)
+            return np.array([]) if ring is None else ring[~np.isnan(ring)] * 1000
+
+
+    def histogram(self, name, bins = 20):
+        """
+        Return the histogram (counts, edges in ms) of a stage's running times in the rolling window
+        """
+        return np.histogram(self.values(name), bins)
+
+
+    def summary(self):
+        """
+        Return the # of samples and the mean, median, 95th percentile and maximum running time (ms) of every stage
+        """
+        with self.lock:
+            names = list(self.samples)
+
+        summary = {}
+        for name in names:
+            values = self.values(name)
+            summary[name] = {"count": self.counts[name], "mean_ms": float(values.mean()),
+                             "p50_ms": float(np.median(values)), "p95_ms": float(np.percentile(values, 95)),
+                             "max_ms": float(values.max())}
+
+        return summary
+
+
+# Metrics of the process, disabled until a script asks for them
+METRICS = Metrics(enabled = False)
+
+def draw_overlay(img, metrics, origin = (10, 30), color = (0, 255, 255)):
+    """
+    Draw the frame rate and the mean running time (ms) of every stage on an image
+    """
+    x, y = origin
+    cv.putText(img, "FPS: %.1f" % metrics.fps(), (x, y), 1, 1.5, color, 2)
+    for name, stats in metrics.summary().items():
+        y += 25
+        cv.putText(img, "%s: %.1f ms" % (name, stats["mean_ms"]), (x, y), 1, 1.2, color, 1)
+
+    return img
+
+
+class MetricsLog:
+    def __init__(self, path, metrics = METRICS, interval = 1.0):
+        """
+        Periodic dump of the metrics' summary, as CSV if the path ends with ".csv", as JSON lines otherwise
+
+        Params:
+            path (str): the output file, appended to
+            metrics (Metrics): the metrics to be dumped
+            interval (float): minimum time (s) between two dumps
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.last = time.perf_counter()
+        self.file = open(path, "a", newline = "")
+        self.writer = None
+        if path.endswith(".csv"):
+            self.writer = csv.writer(self.file)
+            if self.file.tell() == 0:
+                self.writer.writerow(["time", "fps", "stage", "count", "mean_ms", "p50_ms", "p95_ms", "max_ms"])
+
+
+    def write(self, force = False):
+        """
+        Dump the summary if the interval has elapsed since the previous dump
+        """
+        now = time.perf_counter()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+
+        timestamp, fps, summary = time.time(), self.metrics.fps(), self.metrics.summary()
+        if self.writer is not None:
+            for name, stats in summary.items():
+                self.writer.writerow([timestamp, fps, name, stats["count"], stats["mean_ms"],
+                                      stats["p50_ms"], stats["p95_ms"], stats["max_ms"]])
+        else:
+            self.file.write(json.dumps({"time": timestamp, "fps": fps, "stages": summary}) + "\n")
+        self.file.flush()
+
+
+    def close(self):
+        """
+        Dump the last summary and close the file
+        """
+        self.write(force = True)
+        self.file.close()
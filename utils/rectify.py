@@ -1,7 +1,21 @@
+import os
+import zipfile
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2 as cv
 import yaml
 
+try:
+    from utils.metrics import METRICS
+except ImportError:
+    # Imported from the utils folder, e.g. by finetuning.py
+    from metrics import METRICS
+
+# Crop of the rectified frames that contains valid pixels
+RECTIFIED_ROI = (603, 1072)
+
 def get_cam_params(path):
     """
     Get camera's instrinsic matrix and distortion coefficients
@@ -19,38 +33,148 @@ def get_cam_params(path):
     return intrinsic, distort_coeff
     
     
-def transform_mtx(iframe, path = ""):
+def file_hash(path):
     """
-    Find transformation matrix between the input frame and the referenced image
+    Return the SHA-1 digest of a file's content
+    """
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+class ReferenceFeatures:
+    def __init__(self, path = "", mode = "sift"):
+        """
+        Keypoints and descriptors of the referenced image, together with matchers trained on them (one per thread)
+        
+        Params:
+            path (str): relative location of the main folder
+            mode (str): "sift" for SIFT + FLANN, or "orb" for the faster ORB + Hamming brute-force
+        """
+        self.mode = mode
+        self.local = threading.local()
+        
+        # Load the features, or detect them again if the referenced image has changed
+        reference_path = path + 'assets/rectify/book_background.jpg'
+        cache_path = path + 'outputs/reference_' + mode + '.npz'
+        reference_hash = file_hash(reference_path)
+        if not (os.path.exists(cache_path) and self.load(cache_path, reference_hash)):
+            reference = cv.imread(reference_path, cv.IMREAD_GRAYSCALE)
+            self.keypoints, self.descriptors = self.detector().detectAndCompute(reference, None)
+            self.save(cache_path, reference_hash)
+        
+        
+    def detector(self):
+        """
+        Return a new feature detector of the current mode
+        """
+        return cv.ORB_create(nfeatures = 2000) if self.mode == "orb" else cv.SIFT_create()
+    
+    
+    def create_matcher(self):
+        """
+        Return a new, untrained matcher of the current mode
+        """
+        if self.mode == "orb":
+            return cv.BFMatcher(cv.NORM_HAMMING)
+        
+        FLANN_INDEX_KDTREE = 1
+        index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
+        search_params = dict(checks = 50)
+        
+        return cv.FlannBasedMatcher(index_params, search_params)
+    
+    
+    def load(self, filename, reference_hash):
+        """
+        Load the features saved with `save`, return False if they belong to another referenced image
+        """
+        with np.load(filename) as data:
+            if str(data["reference"]) != reference_hash:
+                return False
+            
+            self.keypoints = tuple(cv.KeyPoint(x, y, size, angle, response, int(octave), int(class_id))
+                                   for x, y, size, angle, response, octave, class_id in data["keypoints"])
+            self.descriptors = data["descriptors"]
+            
+        return True
+    
+    
+    def save(self, filename, reference_hash):
+        """
+        Save the keypoints and descriptors of the referenced image
+        
+        Side-effects:
+            Write a new .npz file
+        """
+        keypoints = np.array([[*kp.pt, kp.size, kp.angle, kp.response, kp.octave, kp.class_id] for kp in self.keypoints],
+                             dtype = np.float64).reshape(-1, 7)
+        np.savez(filename, reference = reference_hash, keypoints = keypoints, descriptors = self.descriptors)
+        
+        
+    def thread_matcher(self):
+        """
+        Return the matcher of the current thread, trained on the referenced descriptors on its first use,
+        so that several threads can match at the same time (a trained FLANN index cannot be cloned)
+        """
+        matcher = getattr(self.local, "matcher", None)
+        if matcher is None:
+            matcher = self.local.matcher = self.create_matcher()
+            matcher.add([self.descriptors])
+            matcher.train()
+            
+        return matcher
+    
+    
+    def knn_match(self, descriptors):
+        """
+        Find the 2 nearest referenced descriptors of every input descriptor
+        """
+        return self.thread_matcher().knnMatch(descriptors, k = 2)
+
+
+# Reference features already loaded by this process, keyed by their location and mode
+_REFERENCES = {}
+
+def get_reference(path = "", mode = "sift"):
     """
-    reference = cv.imread(path + 'assets/rectify/book_background.jpg', cv.IMREAD_GRAYSCALE)
+    Return the features of the referenced image, loading them once per process
+    """
+    key = (path, mode)
+    if key not in _REFERENCES:
+        _REFERENCES[key] = ReferenceFeatures(path, mode)
+        
+    return _REFERENCES[key]
+
 
-    # Initiate SIFT detector
-    sift = cv.SIFT_create()
-    MIN_MATCH_COUNT, FLANN_INDEX_KDTREE = 10, 1
+# Threads matching the left and right images, kept alive so that their trained matchers are reused
+_MATCH_POOL = ThreadPoolExecutor(max_workers = 2, thread_name_prefix = "rectify")
 
-    # Find the keypoints and descriptors with SIFT
-    kp1, des1 = sift.detectAndCompute(reference, None)
-    kp2, des2 = sift.detectAndCompute(iframe, None)
+@METRICS.timed()
+def transform_mtx(iframe, path = "", mode = "sift"):
+    """
+    Find transformation matrix between the input frame and the referenced image
+    """
+    reference = get_reference(path, mode)
+    MIN_MATCH_COUNT = 10
+
+    # Find the keypoints and descriptors of the frame
+    kp, des = reference.detector().detectAndCompute(iframe, None)
     
     # Find matches
-    index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
-    search_params = dict(checks = 50)
-    flann = cv.FlannBasedMatcher(index_params, search_params)
-    matches = flann.knnMatch(des1, des2, k = 2)
+    matches = reference.knn_match(des) if des is not None else []
 
     # store all the good matches as per Lowe's ratio test.
     good = []
-    for m,n in matches:
-        if m.distance < 0.7 * n.distance:
-            good.append(m)
+    for pair in matches:
+        if len(pair) == 2 and pair[0].distance < 0.7 * pair[1].distance:
+            good.append(pair[0])
             
     if len(good) < MIN_MATCH_COUNT:
         print( "Not enough matches are found - {}/{}".format(len(good), MIN_MATCH_COUNT))
         
     # Calculate transformation matrix
-    src_pts = np.float32([kp1[m.queryIdx].pt for m in good]).reshape(-1,1,2)
-    dst_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1,1,2)
+    src_pts = np.float32([reference.keypoints[m.trainIdx].pt for m in good]).reshape(-1,1,2)
+    dst_pts = np.float32([kp[m.queryIdx].pt for m in good]).reshape(-1,1,2)
     mtx, _ = cv.findHomography(src_pts, dst_pts, cv.RANSAC,5.0)
 
     return mtx
@@ -65,18 +189,23 @@ def homo_translation(mtx):
         
     return homo
     
+@METRICS.timed()
 def rectify(**kwargs):
     """
     Get parameters to rectify images
     """
     # Get kwargs
     path = kwargs.get('path', "")
-    imgL = kwargs.get('imgL', cv.imread(path + 'assets/mono/position1/left.jpg', cv.COLOR_BGR2GRAY))
-    imgR = kwargs.get('imgR', cv.imread(path + 'assets/mono/position1/right.jpg', cv.COLOR_BGR2GRAY))
+    imgL = kwargs['imgL'] if 'imgL' in kwargs else cv.imread(path + 'assets/mono/position1/left.jpg', cv.COLOR_BGR2GRAY)
+    imgR = kwargs['imgR'] if 'imgR' in kwargs else cv.imread(path + 'assets/mono/position1/right.jpg', cv.COLOR_BGR2GRAY)
     
-    # Get cameras' instrinsic and extrinsic matrices
-    mtx, distort = get_cam_params(path + 'outputs/left.yaml')
-    extL, extR = transform_mtx(imgL, path), transform_mtx(imgR, path)
+    mode = kwargs.get('mode', "sift")
+    camera = kwargs.get('camera')
+    
+    # Get cameras' instrinsic and extrinsic matrices (match both images concurrently)
+    mtx, distort = (camera.intrinsic, camera.distortion) if camera is not None else get_cam_params(path + 'outputs/left.yaml')
+    get_reference(path, mode) # Load the reference once before sharing it between threads
+    extL, extR = _MATCH_POOL.map(lambda img: transform_mtx(img, path, mode), (imgL, imgR))
     
     # Get rotation and translation matrices
     _, _, transL, _ = cv.decomposeHomographyMat(extL, mtx)
@@ -97,22 +226,149 @@ def rectify(**kwargs):
     return results
     
 
+def remap_tables(rectified, dim):
+    """
+    Return the fixed-point (CV_16SC2) undistortion and rectification maps of both cameras
+    """
+    mtx, distort = rectified["mtx"], rectified["distort"]
+    mapL = cv.initUndistortRectifyMap(mtx, distort, rectified["rectifyL"], rectified["prjL"], dim, cv.CV_16SC2)
+    mapR = cv.initUndistortRectifyMap(mtx, distort, rectified["rectifyR"], rectified["prjR"], dim, cv.CV_16SC2)
+    
+    return mapL, mapR
+
+
+def remap(img, maps):
+    """
+    Undistort and rectify an image with precomputed maps, then crop and resize it
+    """
+    img_rect = cv.remap(img, maps[0], maps[1], cv.INTER_LINEAR)
+    
+    return cv.resize(img_rect[:RECTIFIED_ROI[0], :RECTIFIED_ROI[1]], (1280, 720))
+
+
 def undistort(imgL, imgR, rectified):
     """
     Undistort left and right images
     """
-    # Get params
-    mtx, distort = rectified["mtx"], rectified["distort"]
-    prjL, prjR, rectifyL, rectifyR = rectified["prjL"], rectified["prjR"], rectified["rectifyL"], rectified["rectifyR"]
+    # Get the undistortion maps
+    mapL, mapR = remap_tables(rectified, (imgL.shape[1], imgL.shape[0]))
+    
+    return remap(imgL, mapL), remap(imgR, mapR)
+
+
+class RigProfile:
+    def __init__(self, rectified, calibration, maps = None, mode = "sift"):
+        """
+        Rectification of a camera rig together with its precomputed remap tables
+        
+        Params:
+            rectified (dict): the output of `rectify`
+            calibration (str): hash of the calibration file the profile was computed from
+            maps (dict): remap tables of both cameras, keyed by the image dimension
+            mode (str): features the profile was computed with (see `ReferenceFeatures`)
+        """
+        self.rectified = rectified
+        self.calibration = calibration
+        self.maps = maps if maps is not None else {}
+        self.mode = mode
+        
+        
+    @classmethod
+    def compute(cls, imgL, imgR, path = "", mode = "sift", camera = None):
+        """
+        Compute the profile of the rig that captured the input images
+        """
+        rectified = rectify(imgL = imgL, imgR = imgR, path = path, mode = mode, camera = camera)
+        profile = cls(rectified, camera.digest if camera is not None else file_hash(path + 'outputs/left.yaml'),
+                      mode = mode)
+        profile.get_maps((imgL.shape[1], imgL.shape[0]))
+        
+        return profile
+    
     
-    # Undistort the images
-    mapL1, mapL2 = cv.initUndistortRectifyMap(mtx, distort, rectifyL, prjL, (imgL.shape[1], imgL.shape[0]), cv.CV_32FC1)
-    mapR1, mapR2 = cv.initUndistortRectifyMap(mtx, distort, rectifyR, prjR, (imgR.shape[1], imgR.shape[0]), cv.CV_32FC1)
-    imgL_rect = cv.remap(imgL, mapL1, mapL2, cv.INTER_LINEAR)
-    imgR_rect = cv.remap(imgR, mapR1, mapR2, cv.INTER_LINEAR)
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a profile saved with `save`
+        """
+        with np.load(filename) as data:
+            rectified = {key: data[key] for key in ("mtx", "distort", "rectifyL", "rectifyR", "prjL", "prjR")}
+            dim = tuple(int(value) for value in data["dim"])
+            maps = {dim: ((data["mapL1"], data["mapL2"]), (data["mapR1"], data["mapR2"]))}
+            
+            return cls(rectified, str(data["calibration"]), maps, str(data["mode"]))
+    
+    
+    def save(self, filename):
+        """
+        Save the rectification matrices and the remap tables of the first dimension
+        
+        Side-effects:
+            Write a new .npz file, atomically so that other processes never read a partial file
+        """
+        dim, (mapL, mapR) = next(iter(self.maps.items()))
+        temporary = "%s.%d.tmp" % (filename, os.getpid())
+        with open(temporary, "wb") as file:
+            np.savez(file, calibration = self.calibration, mode = self.mode, dim = dim,
+                     mapL1 = mapL[0], mapL2 = mapL[1], mapR1 = mapR[0], mapR2 = mapR[1], **self.rectified)
+        os.replace(temporary, filename)
+    
+    
+    def get_maps(self, dim):
+        """
+        Return the remap tables of both cameras for the input dimension (width, height)
+        """
+        if dim not in self.maps:
+            self.maps[dim] = remap_tables(self.rectified, dim)
+            
+        return self.maps[dim]
+    
+    
+    def undistort_image(self, img, camera = "left"):
+        """
+        Undistort a single image taken by the left or right camera
+        """
+        mapL, mapR = self.get_maps((img.shape[1], img.shape[0]))
+        
+        return remap(img, mapL if camera == "left" else mapR)
     
-    # Crop and resize images
-    imgL_roi = cv.resize(imgL_rect[:603,:1072], (1280, 720))
-    imgR_roi = cv.resize(imgR_rect[:603,:1072], (1280, 720))
+    
+    @METRICS.timed()
+    def undistort(self, imgL, imgR):
+        """
+        Undistort left and right images
+        """
+        return self.undistort_image(imgL, "left"), self.undistort_image(imgR, "right")
+    
+
+# Profiles already loaded by this process, keyed by their file
+_RIG_PROFILES = {}
 
-    return imgL_roi, imgR_roi
\ No newline at end of file
+def load_rig_profile(imgL, imgR, path = "", camera = None, mode = "sift"):
+    """
+    Return the rig profile of a feature mode (see `ReferenceFeatures`), loading it from disk or computing it
+    from the input images if there is none for the current calibration file.
+    Pass the `camera` model (see utils/camera.py) to avoid reading the calibration file.
+    """
+    filename = path + 'outputs/rig_' + mode + '.npz'
+    calibration = camera.digest if camera is not None else file_hash(path + 'outputs/left.yaml')
+    
+    # Reuse the loaded profile while the calibration is the same
+    profile = _RIG_PROFILES.get(filename)
+    if profile is not None and profile.calibration == calibration:
+        return profile
+    
+    # Load the saved profile, or compute it again if it cannot be read or the calibration file or the mode has changed
+    profile = None
+    if os.path.exists(filename):
+        try:
+            profile = RigProfile.load(filename)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            profile = None
+    if profile is None or profile.calibration != calibration or profile.mode != mode:
+        profile = RigProfile.compute(imgL, imgR, path, mode, camera)
+        profile.save(filename)
+        
+    _RIG_PROFILES[filename] = profile
+    
+    return profile
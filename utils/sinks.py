@@ -0,0 +1,129 @@
+import os
+import cv2 as cv
+
+def to_bgr(canvas):
+    """
+    Convert a [0, 1] disparity canvas to an 8-bit BGR image, BGR images are returned as they are
+    """
+    if canvas.dtype != 'uint8':
+        canvas = cv.convertScaleAbs(canvas, alpha = 255)
+    
+    return cv.cvtColor(canvas, cv.COLOR_GRAY2BGR) if canvas.ndim == 2 else canvas
+
+
+class WindowSink:
+    def __init__(self, wait = 1):
+        """
+        Show the results in windows, the GUI must run on the calling thread
+        
+        Params:
+            wait (int): time (ms) given to the windows to refresh after every result
+        """
+        self.wait = wait
+        self.written = 0
+        
+        
+    def write(self, canvas_dispar, canvas_img):
+        """
+        Show a result, return False if "q" has been pressed
+        """
+        cv.imshow("Disparity", canvas_dispar)
+        cv.imshow("Real-life", canvas_img)
+        self.written += 1
+        
+        return cv.waitKey(self.wait) != ord('q')
+    
+    
+    def close(self):
+        """
+        Close the windows
+        """
+        cv.destroyAllWindows()
+        
+        
+class VideoSink:
+    def __init__(self, path, fps = 30, codec = "mp4v"):
+        """
+        Write the results to a video, the image on the left and the disparity on the right
+        
+        Params:
+            path (str): the output video
+            fps (float): frame rate of the video
+            codec (str): FourCC code of the video's codec
+        """
+        self.path, self.fps, self.codec = path, fps, codec
+        self.writer = None
+        self.written = 0
+        
+        
+    def write(self, canvas_dispar, canvas_img):
+        """
+        Append a result to the video, opened with the size of the first result
+        """
+        frame = cv.hconcat([to_bgr(canvas_img), to_bgr(canvas_dispar)])
+        if self.writer is None:
+            self.writer = cv.VideoWriter(self.path, cv.VideoWriter_fourcc(*self.codec), self.fps,
+                                         (frame.shape[1], frame.shape[0]))
+        self.writer.write(frame)
+        self.written += 1
+        
+        return True
+    
+    
+    def close(self):
+        """
+        Finish the video
+        """
+        if self.writer is not None:
+            self.writer.release()
+            
+            
+class ImageSink:
+    def __init__(self, folder, extension = ".jpg"):
+        """
+        Write every result to a numbered pair of images "<frame>.jpg" and "<frame>_dispar.jpg"
+        """
+        os.makedirs(folder, exist_ok = True)
+        self.folder, self.extension = folder, extension
+        self.written = 0
+        
+        
+    def write(self, canvas_dispar, canvas_img):
+        """
+        Write a result to the folder
+        """
+        name = os.path.join(self.folder, "%06d" % self.written)
+        cv.imwrite(name + self.extension, canvas_img)
+        cv.imwrite(name + "_dispar" + self.extension, to_bgr(canvas_dispar))
+        self.written += 1
+        
+        return True
+    
+    
+    def close(self):
+        """
+        Nothing to close, every result is written at once
+        """
+    
+    
+class NullSink:
+    """
+    Drop the results, e.g. to measure the throughput of the pipeline alone
+    """
+    def __init__(self):
+        self.written = 0
+        
+        
+    def write(self, canvas_dispar, canvas_img):
+        """
+        Count a result
+        """
+        self.written += 1
+        
+        return True
+    
+    
+    def close(self):
+        """
+        Nothing to close
+        """
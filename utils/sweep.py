@@ -0,0 +1,294 @@
+import os
+import re
+import glob
+import json
+import time
+import random
+import argparse
+import itertools
+from multiprocessing import Pool
+import numpy as np
+import cv2 as cv
+import yaml
+from disparity import LEVELS, build_pyramid, match, DisparityPyramid, DisparityHistogram
+from rectify import load_rig_profile
+from depth import detect_objects, load_depth_luts
+from camera import load_camera
+
+# Values tried for the parameters of every level (the GaussianBlur kernel must be odd)
+SPACE = {
+    "high": {"kernel": [3, 5], "block": [15, 18, 20], "disparity": [6, 8, 10]},
+    "mid": {"kernel": [3, 5, 7], "block": [15, 18, 21], "disparity": [6, 8]},
+    "low": {"kernel": [5, 7, 9], "block": [11, 15, 19], "disparity": [4, 5, 6]},
+}
+
+def level_choices(space):
+    """
+    Return every combination of the parameters of every level of a search space
+    """
+    choices = {}
+    for name, params in space.items():
+        keys = list(params)
+        choices[name] = [dict(zip(keys, values)) for values in itertools.product(*params.values())]
+
+    return choices
+
+
+def grid(space):
+    """
+    Return every configuration of a search space
+    """
+    choices = level_choices(space)
+
+    return [dict(zip(choices, combination)) for combination in itertools.product(*choices.values())]
+
+
+def random_search(space, count, seed = 0):
+    """
+    Return `count` distinct configurations drawn at random from a search space
+    """
+    choices = level_choices(space)
+    size = int(np.prod([len(values) for values in choices.values()]))
+    rng = random.Random(seed)
+
+    configs, seen = [], set()
+    while len(configs) < min(count, size):
+        config = {name: rng.choice(values) for name, values in choices.items()}
+        key = json.dumps(config, sort_keys = True)
+        if key not in seen:
+            seen.add(key)
+            configs.append(config)
+
+    return configs
+
+
+def default_config(space):
+    """
+    Return the current parameters of the levels (see `LEVELS`) restricted to the searched ones
+    """
+    return {name: {key: LEVELS[name][key] for key in params} for name, params in space.items()}
+
+
+def full_levels(config):
+    """
+    Return the parameters of every level with the configuration's values
+    """
+    return {name: {**params, **config.get(name, {})} for name, params in LEVELS.items()}
+
+
+# Inputs of the worker's process: the pairs, their pyramids and the blurred levels already computed
+_PAIRS = []
+_BLURRED = {}
+
+def distance(path):
+    """
+    Return the rig ("mono" or "stereo") and the distance (cm) of a finetuning image, from its filename
+    """
+    found = re.search(r"(mono|stereo)-(\d+)", os.path.basename(path))
+
+    return found.group(1), float(found.group(2))
+
+
+def init_worker(paths, camera_path):
+    """
+    Load the pairs once per process: rectified, converted to grayscale and resized to every level
+    """
+    # One OpenCV thread per process, the pool already uses every core
+    cv.setNumThreads(1)
+    camera = load_camera(camera_path)
+    dims = [params["dimension"] for params in LEVELS.values()]
+
+    for left in paths:
+        rig, cm = distance(left)
+        gray_imgL = cv.imread(left, cv.IMREAD_GRAYSCALE)
+        gray_imgR = cv.imread(left.replace("left", "right"), cv.IMREAD_GRAYSCALE)
+
+        # Rectify (only the mono rig needs it)
+        if rig == "mono":
+            profile = load_rig_profile(gray_imgL, gray_imgR, path = "../", camera = camera)
+            gray_imgL, gray_imgR = profile.undistort(gray_imgL, gray_imgR)
+
+        levels = dict(zip(LEVELS, zip(build_pyramid(gray_imgL, dims), build_pyramid(gray_imgR, dims))))
+        _PAIRS.append({"name": os.path.basename(left), "rig": rig, "cm": cm, "dim": gray_imgL.shape[::-1],
+                       "levels": levels, "lut": load_depth_luts(camera, "../")[rig]})
+
+
+def blurred(index, name, kernel):
+    """
+    Return the blurred left and right images of a pair's level and the time (s) it took,
+    blurred once per process for every kernel
+    """
+    key = (index, name, kernel)
+    if key not in _BLURRED:
+        start = time.perf_counter()
+        images = tuple(cv.GaussianBlur(img, (kernel, kernel), 0) for img in _PAIRS[index]["levels"][name])
+        _BLURRED[key] = images, time.perf_counter() - start
+
+    return _BLURRED[key]
+
+
+def measure(index, levels):
+    """
+    Return the depth (cm) of the largest object of a pair with the levels' parameters and the running time (s).
+    The depth is converted with the rig's lookup table, as in the pipeline (see `load_depth_luts`).
+    """
+    pair = _PAIRS[index]
+    elapsed, disparities = 0.0, {}
+    for name, params in levels.items():
+        (blur_imgL, blur_imgR), blur_time = blurred(index, name, params["kernel"])
+        start = time.perf_counter()
+        disparities[name] = match(blur_imgL, blur_imgR, params)
+        elapsed += blur_time + time.perf_counter() - start
+
+    # Same steps as utils/finetuning.py
+    start = time.perf_counter()
+    pyramid = DisparityPyramid(disparities, pair["dim"], levels = levels)
+    histogram = DisparityHistogram(pyramid.native("low"), dim = pyramid.dim)
+    range_low = histogram.ranges(0.25, 1.25, 10, 50000)
+    range_mid_high = histogram.ranges(0.05, 0.25, 2, 50000, merge = True)
+    combined = pyramid.combine(range_mid_high)
+
+    detections = detect_objects(combined, range_low, pair["lut"])
+    elapsed += time.perf_counter() - start
+    if len(detections) == 0:
+        return None, elapsed
+
+    return float(detections["depth"][np.argmax(detections["area"])]), elapsed
+
+
+def score(measures):
+    """
+    Return the RMS relative error (%) of the measured depths (cm) of (cm, measured cm) measures,
+    a pair without object counts as a 100% error
+    """
+    errors = [1.0 if measured is None else (measured - cm) / cm for cm, measured in measures]
+
+    return 100 * float(np.sqrt(np.mean(np.square(errors))))
+
+
+def evaluate(task):
+    """
+    Evaluate a configuration on every pair of the process, return its record
+    """
+    i, config, repeat = task
+    levels = full_levels(config)
+
+    measures, runtimes = [], []
+    for index, pair in enumerate(_PAIRS):
+        times = []
+        for _ in range(repeat):
+            measured, elapsed = measure(index, levels)
+            times.append(elapsed)
+        measures.append((pair["cm"], measured))
+        runtimes.append(float(np.median(times)))
+
+    return {"id": i, "config": config, "error_pct": score(measures), "runtime_ms": 1000 * sum(runtimes),
+            "depth_cm": {pair["name"]: measured for pair, (_, measured) in zip(_PAIRS, measures)}}
+
+
+def pareto_front(results):
+    """
+    Return the results that no other result beats on both the error and the running time, fastest first
+    """
+    front, best = [], np.inf
+    for result in sorted(results, key = lambda result: (result["runtime_ms"], result["error_pct"])):
+        if result["error_pct"] < best:
+            front.append(result)
+            best = result["error_pct"]
+
+    return front
+
+
+def choose(front, max_runtime = None):
+    """
+    Return the most accurate result of the front that runs within `max_runtime` (ms), the fastest if none does
+    """
+    within = [result for result in front if max_runtime is None or result["runtime_ms"] <= max_runtime]
+
+    return min(within, key = lambda result: result["error_pct"]) if within else front[0]
+
+
+def main(mode = "random", samples = 64, seed = 0, space = None, workers = None, repeat = 1, max_runtime = None,
+         output = "../outputs/sweep.json", config = "../outputs/disparity.yaml"):
+    """
+    Sweep the SGBM parameters of every level over the finetuning pairs
+
+    Params:
+        mode (str): "grid" to try every configuration of the space, "random" to draw `samples` of them
+        samples (int): # of configurations drawn by the random search
+        seed (int): seed of the random search
+        space (str): YAML file of the values tried for every level's parameters (default: `SPACE`)
+        workers (int): # of processes, all cores if None
+        repeat (int): # of timed runs of every pair, the median is kept
+        max_runtime (float): maximum running time (ms) of the chosen configuration over all the pairs
+        output (str): JSON report of every configuration and of the Pareto front
+        config (str): YAML file of the chosen configuration, loaded by `return_disparity(levels = ...)`
+    """
+    if space is not None:
+        with open(space) as file:
+            space = yaml.safe_load(file)
+    else:
+        space = SPACE
+
+    # The current parameters are always evaluated, as a reference
+    configs = grid(space) if mode == "grid" else random_search(space, samples, seed)
+    baseline = default_config(space)
+    configs = [baseline] + [config for config in configs if config != baseline]
+
+    # Compute the rig profile and the depth lookup tables once before the workers need them
+    paths = sorted(glob.glob("../assets/finetuning/*left.jpg"))
+    mono = [path for path in paths if distance(path)[0] == "mono"]
+    camera_path = "../outputs/left.yaml"
+    camera = load_camera(camera_path)
+    if mono:
+        load_rig_profile(cv.imread(mono[0], cv.IMREAD_GRAYSCALE),
+                         cv.imread(mono[0].replace("left", "right"), cv.IMREAD_GRAYSCALE),
+                         path = "../", camera = camera)
+    load_depth_luts(camera, "../")
+
+    # Evaluate the configurations, the larger chunks reuse more of the blurred images
+    results = []
+    tasks = [(i, config, repeat) for i, config in enumerate(configs)]
+    chunksize = max(1, len(tasks) // (4 * (workers or os.cpu_count())))
+    with Pool(workers, initializer = init_worker, initargs = (paths, camera_path)) as pool:
+        for result in pool.imap_unordered(evaluate, tasks, chunksize):
+            results.append(result)
+            print("%4d/%d: error %6.2f %%, %8.1f ms" % (len(results), len(tasks), result["error_pct"],
+                                                       result["runtime_ms"]))
+    results.sort(key = lambda result: result["id"])
+
+    front = pareto_front(results)
+    chosen = choose(front, max_runtime)
+    with open(output, "w") as file:
+        json.dump({"mode": mode, "space": space, "baseline": results[0], "chosen": chosen, "front": front,
+                   "results": results}, file, indent = 2)
+    with open(config, "w") as file:
+        yaml.safe_dump(chosen["config"], file, default_flow_style = False)
+
+    # Print the summary
+    print("Pareto front:")
+    for result in front:
+        print("  error %6.2f %%, %8.1f ms: %s" % (result["error_pct"], result["runtime_ms"], result["config"]))
+    print("Current: error %.2f %%, %.1f ms" % (results[0]["error_pct"], results[0]["runtime_ms"]))
+    print("Chosen: error %.2f %%, %.1f ms, written to %s" % (chosen["error_pct"], chosen["runtime_ms"], config))
+
+    return chosen
+
+
+if __name__ == "__main__":
+    # Run from the utils folder, like finetuning.py: python sweep.py
+    parser = argparse.ArgumentParser(description = "Sweep the SGBM parameters of every level over the finetuning pairs")
+    parser.add_argument("--mode", choices = ["random", "grid"], default = "random", help = "search strategy")
+    parser.add_argument("--samples", type = int, default = 64, help = "# of configurations of the random search")
+    parser.add_argument("--seed", type = int, default = 0, help = "seed of the random search")
+    parser.add_argument("--space", default = None, help = "YAML file of the values tried for every level")
+    parser.add_argument("--workers", type = int, default = None, help = "# of processes (default: all cores)")
+    parser.add_argument("--repeat", type = int, default = 1, help = "# of timed runs of every pair")
+    parser.add_argument("--max-runtime", type = float, default = None,
+                        help = "maximum running time (ms) of the chosen configuration over all the pairs")
+    parser.add_argument("--output", default = "../outputs/sweep.json", help = "JSON report")
+    parser.add_argument("--config", default = "../outputs/disparity.yaml", help = "chosen configuration")
+    args = parser.parse_args()
+
+    main(args.mode, args.samples, args.seed, args.space, args.workers, args.repeat, args.max_runtime,
+         args.output, args.config)